@@ -0,0 +1,373 @@
+#!/usr/bin/python
+"""
+
+Load test for simplesign.py's enqueue API: starts the real server with
+a fake sign (or uses one that's already running, with --url), fires
+/enqueue_message and /enqueue_sequence requests at it from a number of
+threads, and reports throughput and latency percentiles.
+
+    ./bench.py -c 8 -n 2000 --mix message=4,sequence=1 -o before.json
+    ... change something ...
+    ./bench.py -c 8 -n 2000 --mix message=4,sequence=1 --compare before.json
+
+The fake sign is 'fake:9600' by default, so writes take as long as they
+would over a real serial line and the sign loop is kept busy while the
+requests come in.
+
+"""
+
+import httplib
+import json
+import logging
+from optparse import OptionParser
+import os
+import os.path
+import random
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+
+LOG = logging.getLogger(__name__)
+
+ENDPOINTS = {
+    'message' : '/enqueue_message',
+    'sequence' : '/enqueue_sequence',
+}
+
+WORDS = ("build", "broken", "lunch", "is", "here", "deploy", "finished",
+         "meeting", "in", "five", "minutes", "coffee", "pot", "empty")
+
+PERCENTILES = (50, 90, 99)
+
+
+def random_text(max_length):
+    words = []
+    while len(" ".join(words)) < random.randint(5, max_length):
+        words.append(random.choice(WORDS))
+    return " ".join(words)[:max_length]
+
+
+def make_payload(kind, text_length):
+    message = { 'text' : random_text(text_length),
+                'color' : random.choice(('RED', 'GREEN', 'AMBER')),
+                'mode' : random.choice(('ROTATE', 'HOLD')) }
+    if kind == 'message':
+        return message
+    return { 'duration' : 30, 'messages' : [message] }
+
+
+def parse_mix(spec):
+    """Returns list of (kind, weight) for a --mix value like
+    message=4,sequence=1
+    """
+    mix = []
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ENDPOINTS:
+            raise ValueError("Unknown request kind: %s" % (kind,))
+        mix.append((kind, float(weight or 1)))
+    return mix
+
+
+def choose(mix):
+    r = random.uniform(0, sum(weight for kind, weight in mix))
+    for kind, weight in mix:
+        r -= weight
+        if r <= 0:
+            return kind
+    return mix[-1][0]
+
+
+def start_server(options):
+    """Start simplesign.py with a fake sign; returns the Popen"""
+    here = os.path.dirname(os.path.realpath(__file__))
+    args = [sys.executable, os.path.join(here, "simplesign.py"),
+            "-m", options.module,
+            "-d", options.device,
+            "-p", str(options.port),
+            "--log-file", options.server_log,
+            # we're measuring the handlers, not the limits
+            "--rate", "0",
+            "--max-messages", str(options.requests)]
+    LOG.info("Starting %s", " ".join(args))
+    return subprocess.Popen(args)
+
+
+def wait_for_server(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = httplib.HTTPConnection(host, port, timeout=1)
+            conn.request("GET", "/current")
+            if conn.getresponse().status == 200:
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise Exception("Server at %s:%d didn't come up" % (host, port))
+
+
+class Worker(threading.Thread):
+    """Sends requests until the shared counter runs out, recording
+    (kind, status, latency) for each
+    """
+
+    def __init__(self, host, port, mix, text_length, counter, lock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.mix = mix
+        self.text_length = text_length
+        self.counter = counter
+        self.lock = lock
+        self.results = []
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.counter[0] <= 0:
+                    return
+                self.counter[0] -= 1
+            kind = choose(self.mix)
+            body = json.dumps(make_payload(kind, self.text_length))
+            start = time.time()
+            try:
+                # the server speaks HTTP/1.0, so a connection per request
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=30)
+                conn.request("POST", ENDPOINTS[kind], body)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+                conn.close()
+            except Exception as e:
+                status = 'error: %s' % (e.__class__.__name__,)
+            self.results.append((kind, status, time.time() - start))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency for kind, status, latency in results)
+    statuses = {}
+    for kind, status, latency in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {
+        'requests' : len(results),
+        'throughput' : len(results) / elapsed if elapsed else 0,
+        'statuses' : statuses,
+        'max_ms' : latencies[-1] * 1000 if latencies else None,
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary['p%d_ms' % (p,)] = value * 1000 if value is not None else None
+    return summary
+
+
+def run_benchmark(host, port, options):
+    mix = parse_mix(options.mix)
+    counter = [options.requests]
+    lock = threading.Lock()
+    workers = [Worker(host, port, mix, options.text_length, counter, lock)
+               for i in range(options.concurrency)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    results = []
+    for worker in workers:
+        results.extend(worker.results)
+
+    report = { 'overall' : summarize(results, elapsed) }
+    for kind, weight in mix:
+        report[kind] = summarize([r for r in results if r[0] == kind], elapsed)
+    return report
+
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.realpath(__file__))
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=here, stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+
+def fmt(value, spec="%.1f"):
+    if value is None:
+        return "-"
+    return spec % (value,)
+
+
+def print_report(report):
+    print "%-10s %8s %10s %8s %8s %8s %8s  %s" % (
+        "", "requests", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "statuses")
+    for name in ['overall'] + sorted(k for k in report if k != 'overall'):
+        r = report[name]
+        statuses = ", ".join("%s: %d" % (s, n) for s, n in sorted(r['statuses'].items()))
+        print "%-10s %8d %10s %8s %8s %8s %8s  %s" % (
+            name, r['requests'], fmt(r['throughput']), fmt(r['p50_ms']),
+            fmt(r['p90_ms']), fmt(r['p99_ms']), fmt(r['max_ms']), statuses)
+
+
+def print_comparison(old, new):
+    """Print how new's results differ from old's (both as saved with
+    --output)
+    """
+    print
+    print "Compared to %s (%s):" % (old.get('git_revision') or "previous run", old.get('time'))
+    for name in ['overall'] + sorted(k for k in new['report'] if k != 'overall'):
+        if name not in old['report']:
+            continue
+        before = old['report'][name]
+        after = new['report'][name]
+        changes = []
+        for key, label in [('throughput', 'req/s')] + \
+                [('p%d_ms' % (p,), 'p%d' % (p,)) for p in PERCENTILES]:
+            if before.get(key) and after.get(key) is not None:
+                change = (after[key] - before[key]) / before[key] * 100
+                changes.append("%s %s -> %s (%+.0f%%)" % (label, fmt(before[key]), fmt(after[key]), change))
+        print "%-10s %s" % (name, ", ".join(changes))
+
+
+def main():
+    parser = OptionParser("%prog [options]")
+    parser.add_option("-u", "--url",
+                      help="benchmark the simplesign.py already running at "
+                      "this URL, instead of starting one",
+                      action="store",
+                      type="string",
+                      dest="url",
+                      default=None)
+    parser.add_option("-c", "--concurrency",
+                      help="number of clients sending requests at once "
+                      "(default %default)",
+                      action="store",
+                      type="int",
+                      dest="concurrency",
+                      default=4)
+    parser.add_option("-n", "--requests",
+                      help="total number of requests (default %default)",
+                      action="store",
+                      type="int",
+                      dest="requests",
+                      default=1000)
+    parser.add_option("--mix",
+                      help="kinds of request to send, with their relative "
+                      "weights (default %default)",
+                      action="store",
+                      type="string",
+                      dest="mix",
+                      default="message=4,sequence=1")
+    parser.add_option("--text-length",
+                      help="max length of message text (default %default)",
+                      action="store",
+                      type="int",
+                      dest="text_length",
+                      default=60)
+    parser.add_option("-m", "--module",
+                      help="config module for the server to run "
+                      "(default %default)",
+                      action="store",
+                      type="string",
+                      dest="module",
+                      default="config-sample")
+    parser.add_option("-d", "--device",
+                      help="fake device for the server to write to "
+                      "(default %default)",
+                      action="store",
+                      type="string",
+                      dest="device",
+                      default="fake:9600")
+    parser.add_option("-p", "--port",
+                      help="port for the server to use (default %default)",
+                      action="store",
+                      type="int",
+                      dest="port",
+                      default=8099)
+    parser.add_option("--server-log",
+                      help="where the server logs to (default %default)",
+                      action="store",
+                      type="string",
+                      dest="server_log",
+                      default="bench-server.log")
+    parser.add_option("-o", "--output",
+                      help="save the results as JSON to this file",
+                      action="store",
+                      type="string",
+                      dest="output",
+                      default=None)
+    parser.add_option("--compare",
+                      help="compare the results with a previous run's "
+                      "--output file",
+                      action="store",
+                      type="string",
+                      dest="compare",
+                      default=None)
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.INFO)
+
+    try:
+        parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = None
+    if options.url:
+        url = urlparse.urlparse(options.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "localhost", options.port
+        server = start_server(options)
+
+    try:
+        wait_for_server(host, port)
+        LOG.info("Sending %d requests from %d clients...", options.requests, options.concurrency)
+        report = run_benchmark(host, port, options)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+
+    result = {
+        'time' : time.strftime("%Y-%m-%d %H:%M:%S"),
+        'git_revision' : git_revision(),
+        'options' : {
+            'concurrency' : options.concurrency,
+            'requests' : options.requests,
+            'mix' : options.mix,
+            'text_length' : options.text_length,
+            'device' : None if options.url else options.device,
+            'module' : None if options.url else options.module,
+        },
+        'report' : report,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        LOG.info("Results saved to %s", options.output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            print_comparison(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,15 +15,17 @@ for your own purposes.
 import datetime
 import Queue
 import logging
-import os.path
 import random
 import time
-import traceback
 import urllib
 import xml.etree.ElementTree as ET
 
-from bs4 import BeautifulSoup
-import requests
+import sources
+
+# these are slow to import, so they're only imported when first used,
+# by a source refreshing in the background
+bs4 = sources.LazyModule('bs4')
+requests = sources.LazyModule('requests')
 
 
 LOG = logging.getLogger(__name__)
@@ -90,8 +92,7 @@ def make_messages(**outer_kwargs):
             try:
                 results = function(*args, **kwargs)
             except Exception as e:
-                LOG.error("Error running %s: %s" % (function.__name__, str(e)))
-                LOG.error(traceback.format_exc())
+                LOG.exception("Error running %s: %s", function.__name__, e)
                 return []
 
             msgs = [{ 'text' : i, 'mode' : mode, 'speed' : speed, 'color' : color } for i in results]
@@ -121,7 +122,7 @@ def filter_(msg):
         msg['text'].decode('ascii')
     except UnicodeEncodeError:
         try:
-            LOG.info("Couldn't decode into ascii, filtering out: %s" % (msg['text'],))
+            LOG.info("Couldn't decode into ascii, filtering out: %s", msg['text'])
         except:
             LOG.info("Couldn't decode a message (undisplayable) into ascii, filtering out.")
         return False
@@ -159,11 +160,11 @@ class Cache(object):
             time_diff = time.time() - last_updated
 
             if (time_diff > self.cache_time) or key not in self.cache:
-                LOG.info("%s cache miss" % (func.__name__,))
+                LOG.debug("%s cache miss", func.__name__)
                 self.cache[key] = func(*args, **kwargs)
                 self.last_updated[key] = time.time()
             else:
-                LOG.info("%s cache hit" % (func.__name__,))
+                LOG.debug("%s cache hit", func.__name__)
 
             return self.cache[key]
 
@@ -189,47 +190,43 @@ def cached_fetch(url):
 def tweets(twitter_name):
     text = cached_fetch("https://twitter.com/%s" % (twitter_name,))
 
-    bs = BeautifulSoup(text)
+    bs = bs4.BeautifulSoup(text)
 
     #contents = [div for div in bs.find_all("div") if "content" in div.get('class','')]
 
     tweets = [p.text for p in bs.find_all("p") if "tweet-text" in p.get('class','')]
     return tweets
 
-QUIPS = []
-
-@make_messages()
-def quips():
-    # quips.html is the output from our bugzilla server, which we
-    # manually refresh as a disk file periodically, because bugzilla
-    # requires authentication, so we can't hit the page directly.
-    global QUIPS
-    if len(QUIPS) == 0 and os.path.exists("quips.html"):
-        f = open("quips.html")
-        contents = f.read()
-        f.close()
+def parse_quips(contents):
+    bs = bs4.BeautifulSoup(contents)
 
-        bs = BeautifulSoup(contents)
+    # should be third table
+    table = bs.find_all('table')[2]
 
-        # should be third table
-        table = bs.find_all('table')[2]
+    rows = table.find_all('tr')[1:]
 
-        rows = table.find_all('tr')[1:]
+    # def row_author(row):
+    #     return row.find_all("td")[1].text.strip()
+    def row_quip(row):
+        return row.find("td").text.strip()
 
-        # def row_author(row):
-        #     return row.find_all("td")[1].text.strip()
-        def row_quip(row):
-            return row.find("td").text.strip()
+    return [row_quip(row) for row in rows]
 
-        QUIPS = [row_quip(row) for row in rows]
+# quips.html is the output from our bugzilla server, which we manually
+# refresh as a disk file periodically, because bugzilla requires
+# authentication, so we can't hit the page directly. It's re-parsed
+# whenever it changes.
+QUIPS = sources.WatchedFile("quips.html", parse_quips)
 
-    return QUIPS
+@make_messages()
+def quips(n):
+    return QUIPS.snapshot.sample(n)
 
 
 def parse_blamelist(build_url):
     r = requests.get(build_url)
     html = r.text
-    bs = BeautifulSoup(html)
+    bs = bs4.BeautifulSoup(html)
 
     # kinda fragile!
 
@@ -257,7 +254,7 @@ def buildbot():
         except Exception as e:
             text = "Buildbot FAIL"
         html = r.text
-        bs = BeautifulSoup(html)
+        bs = bs4.BeautifulSoup(html)
 
         # doc structure is slightly diff when test is in progress
         if "Currently Building" in html:
@@ -349,7 +346,7 @@ def democracynow():
     # they store a chunk of html in here containing all headlines in UL tree
     html = i.find("{http://purl.org/rss/1.0/modules/content/}encoded").text
 
-    bs = BeautifulSoup(html)
+    bs = bs4.BeautifulSoup(html)
 
     headlines = [link.text for link in bs.find_all("a")]
 
@@ -418,7 +415,7 @@ def more_quotes():
 @make_messages(color='GREEN', mode='ROTATE')
 def weather():
     text = cached_fetch("http://www.wunderground.com/cgi-bin/findweather/getForecast?query=39.943%2C-75.172&sp=KPAPHILA35")
-    bs = BeautifulSoup(text)
+    bs = bs4.BeautifulSoup(text)
 
     current_temp = int(float(bs.find(id='rapidtemp')["value"]))
     feels_like = int(float(bs.find(id='tempFeel').find(class_='b').text))
@@ -473,13 +470,22 @@ def time_now():
     ampm = now.strftime("%p").lower()
     return hour + ":" + minute + ampm
 
+
+# live fields, used as {name} in message text: name -> (function,
+# refresh interval in secs). simplesign.py keeps these in small STRING
+# files on the sign, so the clock ticks without re-sending messages.
+LIVE_FIELDS = {
+    'time' : (time_now, 10),
+    }
+
+
 def system_stats():
     """
     System status messages
     """
     messages = []
 
-    messages.append({ 'text' : 'Status ' + time_now(), 'mode' : 'HOLD', 'speed' : 'SPEED_1' })
+    messages.append({ 'text' : 'Status {time}', 'mode' : 'HOLD', 'speed' : 'SPEED_1' })
 
     status_functions = [
         buildbot,
@@ -491,7 +497,7 @@ def system_stats():
         try:
             ret_val = fn()
         except Exception as e:
-            LOG.error("ERROR in sign_sequence running %s: %s" % (fn.__name__, str(e)))
+            LOG.error("ERROR in sign_sequence running %s: %s", fn.__name__, e)
         if ret_val:
             messages.extend(ret_val)
 
@@ -515,7 +521,7 @@ def messages_in_pool(message_queue):
     while not stop:
         # move stuff from message_queue into our pool
         try:
-            message = message_queue.get(True, 1)
+            message = message_queue.get_nowait()
             POOL.append((time.time(), message))
         except Queue.Empty:
             stop = True
@@ -541,20 +547,19 @@ def weekend():
     return msgs
 
 
-def fun_stuff(n, message_queue):
-    """Return all messages in POOL, OR if that's less than n,
-    supplement with msgs from other fun sources
+def fun_stuff(n, pool, candidates, weekend_msgs):
+    """Return all messages in pool, OR if that's less than n,
+    supplement with random picks from candidates
     """
     # all messages from pool, even if this exceeds n
-    funstuff = messages_in_pool(message_queue)
+    funstuff = list(pool)
 
     # if we don't have enough fun stuff, add more
-    if len(funstuff) < n:
-        fill = n - len(funstuff)
-        candidates = onion() + more_quotes()
+    if len(funstuff) < n and candidates:
+        fill = min(n - len(funstuff), len(candidates))
         funstuff.extend(random_from_list(fill, candidates))
 
-    funstuff += weekend()
+    funstuff += weekend_msgs
 
     return funstuff
 
@@ -568,17 +573,58 @@ def interleave_pauses(messages):
     return result
 
 
-def sign_sequence(ctx):
-    stats = system_stats()
+# Each source is refreshed on its own schedule in the background;
+# the sequence is only recomposed when one of them changes.
+STORE = sources.SourceStore()
+STORE.add('stats', system_stats, 60)
+STORE.add('weather', weather, 15 * 60)
+STORE.add('quips', lambda: quips(4), 5 * 60, watch=[QUIPS])
+STORE.add('news', lambda: news(random=4), 5 * 60)
+STORE.add('fun', lambda: onion() + more_quotes(), 30 * 60)
+STORE.add('weekend', weekend, 60 * 60)
+
+
+# shown while sources are still loading and there's nothing else yet
+STARTING_UP = { 'duration' : 'auto', 'placeholder' : True,
+                'messages' : [{ 'text' : 'Starting up...', 'mode' : 'HOLD', 'color' : 'AMBER' }] }
+
+
+@STORE.composer
+def compose(values):
+    stats = values['stats']
 
     pause = { 'text' : ' ' * 10, 'mode' : 'HOLD', 'speed' : 'SPEED_1' }
 
+    funstuff = fun_stuff(4, values.get('pool', []), values['fun'], values['weekend'])
+
     # our sequence: we do some shenanigans here to time msgs and
-    # pauses to improve readability on the sign
-    messages = stats + [ pause ] + weather() + [ pause ] + \
-        interleave_pauses(quips(random=4)) + \
-        stats + [ pause ] + interleave_pauses(news(random=4)) + \
-        stats + [ pause ] + interleave_pauses(fun_stuff(4, ctx['message_queue']))
-
-    five_mins = 60 * 5
-    return { 'duration' : five_mins, 'messages' : messages }
+    # pauses to improve readability on the sign. Sources still loading
+    # are empty, so leave out their pauses too
+    weather = values['weather']
+    if weather:
+        weather = weather + [ pause ]
+    blocks = [ weather + interleave_pauses(values['quips']),
+               interleave_pauses(values['news']),
+               interleave_pauses(funstuff) ]
+
+    messages = []
+    for block in blocks:
+        if block:
+            if stats:
+                messages += stats + [ pause ]
+            messages += block
+
+    if not messages:
+        if not stats and STORE.loading():
+            return STARTING_UP
+        messages = stats
+
+    # show everything twice; the store has sign_sequence() called again
+    # sooner if anything changes
+    return { 'duration' : 'auto', 'cycles' : 2, 'messages' : messages }
+
+
+def sign_sequence(ctx):
+    STORE.start(ctx)
+    STORE.set('pool', messages_in_pool(ctx['message_queue']), notify=False)
+    return compose()
@@ -21,25 +21,65 @@ def _is_active():
         t.tm_hour >= 8 and t.tm_hour <= 19
 
 
+# RENAME THIS TO LIVE_FIELDS TO GET IT TO TAKE EFFECT
+_LIVE_FIELDS = {
+    # name : (function returning the value, refresh interval in secs)
+    'time' : (lambda: time.strftime("%H:%M"), 10),
+    }
+"""
+Live fields can be used in message text as {name}, eg. 'It is {time}'.
+Each one is kept in a small STRING file on the sign that's rewritten
+whenever its value changes, so frequently changing values don't cause
+whole messages to be re-sent. This doesn't need to exist.
+"""
+
+
 def sign_sequence(ctx):
     """
-    ctx = dict containing 'context' data from the sign script;
-    currently, this just has the key 'message_queue' which is a Queue
-    of msgs.
+    ctx = dict containing 'context' data from the sign script:
+
+    'message_queue' : a Queue of msgs submitted through the web API
+    'refresh'       : function to call (from any thread) when something
+                      has changed, to have sign_sequence() called again
+                      right away rather than after 'duration'. See
+                      sources.py for a way to use it.
+
+    Returning the very same sequence object as the previous call tells
+    the sign script nothing has changed, so it can skip comparing the
+    messages against what's on the sign.
 
     sign_sequence() should return a dict representing a Sequence to be
     sent to the sign, containing the keys:
 
-    'duration' : int duration to run the sequence, in seconds
+    'duration' : int duration to run the sequence, in seconds, or
+                 'auto' to have it worked out from how long the
+                 messages take to show
     'messages' : a list of dicts describing a set of Messages to run
 
+    and optionally:
+
+    'cycles'    : with 'duration' : 'auto', how many times to run
+                  through the messages (default 1)
+    'max_cycle' : secs; if the messages would take longer than this to
+                  run through once, drop the lowest priority ones
+    'placeholder' : True for a stand-in shown while the real sequence
+                  isn't ready yet (eg. "Starting up..."); with --isolate,
+                  a restarted worker's placeholder doesn't replace the
+                  last real sequence
+
     A Message is a dict that consists of:
 
-    'text'  : (required) str of text to display
+    'text'  : (required) str of text to display, which can include
+              {name} placeholders for LIVE_FIELDS
     'mode'  : (optional) str indicating a mode (see alphasign docs).
               defaults to 'ROTATE'
     'speed' : (optional) str indicating speed (SPEED_1 to SPEED_5)
     'color' : (optional) str indicating a color (see alphasign docs)
+    'priority' : (optional) number used to decide what to drop when
+              the sequence has a 'max_cycle' (default 0)
+    'sign'  : (optional) name, or list of names, of the signs to show
+              the message on (see the --device option). defaults to
+              all signs
 
     Python alphasign docs can be found here:
 
@@ -1,2 +1,2 @@
 #!/bin/sh
-./simplesign.py -m config-sample >> simplesign.log 2>> simplesign.log &
+./simplesign.py -m config-sample --log-file simplesign.log 2>> simplesign.err &
@@ -14,7 +14,9 @@ This is a simple application for BetaBrite LED signs, designed to:
 This code consists of:
 
 - a main loop that repeatedly calls a function for data to send to the
-  sign.
+  sign(s).
+
+- a writer thread per sign, which writes only what changed.
 
 - a web server API that allows for queuing of messages, plus a simple
   HTML front end
@@ -23,13 +25,26 @@ This code consists of:
 
 import BaseHTTPServer
 import Queue
+import atexit
+import cStringIO
+import collections
 import glob
+import gzip
+import hashlib
 import imp
 import json
 import logging
+import logging.handlers
+import multiprocessing
 from optparse import OptionParser
 import os
 import os.path
+import re
+import signal
+import socket
+import SocketServer
+import stat
+import struct
 import sys
 import threading
 import time
@@ -37,29 +52,591 @@ import traceback
 
 import alphasign
 
+import sources
+
 LOG = logging.getLogger(__name__)
 
-SEQUENCE_QUEUE = Queue.Queue()
-MESSAGE_QUEUE = Queue.Queue()
+
+class SequenceQueue(Queue.Queue):
+    """Queue of pre-empting sequences. Each one pre-empts whatever's
+    showing, so a sequence waiting behind another for the same sign(s)
+    would only flash by before being replaced. offer() drops those
+    instead of letting them pile up.
+    """
+
+    def offer(self, seq):
+        """Add seq, replacing any queued sequences it supersedes.
+        Returns False if the queue is still full.
+        """
+        key = routing_key(seq)
+        with self.mutex:
+            superseded = [s for s in self.queue if routing_key(s) == key]
+            for s in superseded:
+                self.queue.remove(s)
+            if superseded:
+                LOG.info("Dropped %d queued sequence(s) superseded by a newer one", len(superseded))
+            if 0 < self.maxsize <= self._qsize():
+                return False
+            self._put(seq)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+
+class RateLimiter(object):
+    """Token bucket per client: each client can make 'burst' requests
+    at once, refilled at 'rate' per second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._lock = threading.Lock()
+        # client -> (tokens, time last refilled)
+        self._buckets = {}
+
+    def acquire(self, client):
+        """Takes a token for client. Returns 0 if there was one,
+        otherwise the number of secs until there will be.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[client] = (tokens - 1, now)
+                if len(self._buckets) > MAX_RATE_LIMITED_CLIENTS:
+                    self._expire(now)
+                return 0
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _expire(self, now):
+        """Forget clients whose buckets have refilled anyway"""
+        for client, (tokens, last) in self._buckets.items():
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self._buckets[client]
+
+
+# defaults for the queue and rate limiting options; see main()
+MAX_QUEUED_MESSAGES = 100
+MAX_QUEUED_SEQUENCES = 10
+RATE = 1.0
+BURST = 10
+
+# most bytes we'll read from a request body
+MAX_POST_SIZE = 64 * 1024
+
+# secs an HTTP client gets to send its request (or take what we send
+# it) before the connection's dropped, so a stalled one can't keep a
+# handler thread forever
+HTTP_TIMEOUT = 10
+
+# number of clients to track before dropping idle ones
+MAX_RATE_LIMITED_CLIENTS = 1000
+
+SEQUENCE_QUEUE = SequenceQueue(MAX_QUEUED_SEQUENCES)
+MESSAGE_QUEUE = Queue.Queue(MAX_QUEUED_MESSAGES)
+
+RATE_LIMITER = RateLimiter(RATE, BURST)
 
 SHUTDOWN = False
 
+# set by modules (through ctx['refresh']) to have sign_sequence()
+# called again right away, because something changed
+REFRESH = threading.Event()
+
+# (messages, duration, active) most recently handed to all signs, so
+# signs that show up later can catch up
+LAST_SUBMISSION = None
+
+# TraceRecorder, with --record
+RECORDER = None
+
+# how much faster than real time sign_loop runs; > 1 when replaying a
+# trace
+SPEED = 1.0
+
 # this is an arbitrarily high number < 93, which is the num of unique
 # text file labels available. I don't know how high you can go before
 # the sign runs out of memory.
 NUM_TEXTFILES = 60
 
+# Rough model of how long the sign takes to show things, used to size
+# sequences; see estimate_display_time(). These are eyeballed from a
+# BetaBrite Classic, so tune them for your sign.
+SIGN_WIDTH = 14
+# secs a screenful of text stays up in HOLD and the transition modes
+HOLD_TIME = 4.0
+# secs for a transition (ROLL_UP, WIPE_IN...) at the fastest speed
+TRANSITION_TIME = 1.0
+# secs for ROTATE to move one character at the fastest speed
+SCROLL_CHAR_TIME = 0.12
+SCROLLING_MODES = ('ROTATE', 'COMPRESSED_ROTATE')
+# how much slower each speed is than the fastest, which is what the
+# sign uses when there's no speed code
+SPEED_FACTORS = {
+    'SPEED_1' : 2.5,
+    'SPEED_2' : 2.0,
+    'SPEED_3' : 1.6,
+    'SPEED_4' : 1.3,
+    'SPEED_5' : 1.0,
+    }
+# shortest duration 'auto' will come up with, in secs
+MIN_DURATION = 30
+
+# how many entries a run sequence can have; messages repeated in a
+# sequence share a textfile, so this can be more than NUM_TEXTFILES.
+# I don't know what the sign's real limit is.
+MAX_RUN_LENGTH = 128
+
+# number and size of the small STRING files backing live fields (see
+# LIVE_FIELDS in config-sample.py). These share the label space with
+# the textfiles.
+NUM_STRINGFILES = 10
+STRING_SIZE = 32
+
+# there are 93 valid labels (see p. 50 of docs)
+LABELS = [chr(x) for x in range(0x20, 0x7E + 1) if x != 0x30 and x != 0x3F]
+TEXT_LABELS = LABELS[:NUM_TEXTFILES]
+STRING_LABELS = LABELS[NUM_TEXTFILES:NUM_TEXTFILES + NUM_STRINGFILES]
+
+# live field name -> STRING file label; see register_fields()
+FIELDS = {}
+
+# STRING file label -> latest live field value
+FIELD_VALUES = {}
+
+# directory (relative to the app dir) holding the frontend's bundled
+# assets, served under /static/
+STATIC_DIR = "static"
+
+CONTENT_TYPES = {
+    ".css" : "text/css",
+    ".html" : "text/html",
+    ".js" : "application/javascript",
+    ".png" : "image/png",
+    ".ico" : "image/x-icon",
+    }
+
+# only these get a gzipped copy; images are already compressed
+COMPRESSIBLE_TYPES = ("text/css", "text/html", "application/javascript")
+
+# how often (secs) to ping idle sign agents; agents reconnect if they
+# hear nothing for three times this long
+AGENT_PING = 30
+
+# how often (secs) to send a comment down idle event streams, so
+# proxies don't drop them and we notice clients that went away
+EVENTS_KEEPALIVE = 15
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(message)s'
+
+# log records waiting to be written; more than this and they're dropped
+# rather than holding anything up
+LOG_QUEUE_SIZE = 10000
+
+# at most LOG_BURST records with the same message every LOG_INTERVAL
+# secs; the rest are counted and skipped
+LOG_INTERVAL = 60
+LOG_BURST = 20
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+# with --isolate, how long (secs) the worker process gets for each call
+# before it's assumed to be hung and killed, and how many sign_sequence()
+# calls before it's replaced with a fresh one (0 for never). A fresh
+# worker starts the module from scratch, losing whatever it kept
+WORKER_TIMEOUT = 180
+WORKER_MAX_CALLS = 0
+
+
+class QueueHandler(logging.Handler):
+    """Hands log records to a queue for a LogListener to write out, so
+    logging never waits on the disk. Records are formatted by the
+    listener, not the caller, unless eager is set (for records that
+    have to be pickled to go to another process). If the queue's full,
+    records are dropped and counted.
+    """
+
+    def __init__(self, queue, eager=False):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.eager = eager
+        self.dropped = 0
+
+    def emit(self, record):
+        if record.exc_info:
+            # the traceback has to be rendered while it's still around
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.eager:
+            record.msg = record.getMessage()
+            record.args = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name' : LOG.name, 'levelno' : logging.WARNING, 'levelname' : 'WARNING',
+                    'msg' : "Dropped %d log records, logging can't keep up", 'args' : (dropped,) }))
+            except Queue.Full:
+                self.dropped += dropped
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records with the same message every
+    interval secs. Messages are compared before formatting, so eg.
+    every "Displaying msg: %s" counts as the same message. The number
+    skipped is tacked onto the first one let through afterwards.
+    """
+
+    def __init__(self, interval=LOG_INTERVAL, burst=LOG_BURST):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.lock = threading.Lock()
+        # (logger name, msg) -> [window start, count, skipped]
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.time()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                skipped = window[2] if window else 0
+                window = [now, 0, 0]
+                self.windows[key] = window
+                if skipped:
+                    record.msg = "%s [%d similar messages skipped]" % (record.msg, skipped)
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                return False
+            return True
+
+
+class LogListener(object):
+    """Thread that writes out what a QueueHandler queues"""
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.run)
+        # stopped by stop(), at exit, after everything else is done
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(level, log_file=None, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Log to stderr, or to log_file (rotated once it reaches
+    max_bytes), through a queue and a writer thread
+    """
+    if log_file:
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes,
+                                                       backupCount=backups)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    queue = Queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = QueueHandler(queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    LogListener(queue, [handler]).start()
+
+
+def _constants(module):
+    """Returns dict of name -> protocol code for the constants in one
+    of alphasign's modules
+    """
+    return dict((name, getattr(module, name)) for name in dir(module) if name.isupper())
+
+
+MODES = _constants(alphasign.modes)
+COLORS = _constants(alphasign.colors)
+SPEEDS = _constants(alphasign.speeds)
+
 
 def get_mode(mode_str):
-    return getattr(alphasign.modes, mode_str, None)
+    return MODES.get(mode_str)
 
 
 def get_color(color_str):
-    return getattr(alphasign.colors, color_str, None)
+    return COLORS.get(color_str)
 
 
 def get_speed(speed_str):
-    return getattr(alphasign.speeds, speed_str, None)
+    return SPEEDS.get(speed_str)
+
+
+class LRUCache(object):
+    """Thread-safe cache that keeps the maxsize most recently used
+    items
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key, make):
+        """Returns the value for key, calling make() to create it if
+        it's not cached
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+            except KeyError:
+                pass
+
+        value = make()
+
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+
+# (text, color, speed, mode) -> (mode code, data)
+MESSAGE_CACHE = LRUCache(1024)
+
+# (label, (mode code, data)) -> bytes of the packet that writes it
+FRAME_CACHE = LRUCache(1024)
+
+
+class StaticFile(object):
+    """A file loaded into memory, along with everything needed to
+    serve it: an ETag and, for text types, a gzipped copy of the body.
+    """
+
+    def __init__(self, path, mtime, size, body):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.body = body
+        self.etag = '"%s"' % (hashlib.md5(body).hexdigest(),)
+        ext = os.path.splitext(path)[1].lower()
+        self.content_type = CONTENT_TYPES.get(ext, "application/octet-stream")
+
+        self.gzipped = None
+        if self.content_type in COMPRESSIBLE_TYPES:
+            buf = cStringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0)
+            f.write(body)
+            f.close()
+            if buf.tell() < len(body):
+                self.gzipped = buf.getvalue()
+
+
+class StaticCache(object):
+    """Process-wide cache of files served by HttpHandler. A new
+    handler is created for every request, so this lives at module
+    level. Entries are re-read when the file's mtime or size changes,
+    so editing frontend.html doesn't require a restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def get(self, path):
+        """Returns a StaticFile for path; raises IOError/OSError if it
+        can't be read.
+        """
+        st = os.stat(path)
+        entry = self._files.get(path)
+        if entry is None or entry.mtime != st.st_mtime or entry.size != st.st_size:
+            LOG.debug("Loading static file %s", path)
+            f = open(path, "rb")
+            body = f.read()
+            f.close()
+            entry = StaticFile(path, st.st_mtime, st.st_size, body)
+            with self._lock:
+                self._files[path] = entry
+        return entry
+
+
+STATIC_CACHE = StaticCache()
+
+
+class Broadcaster(object):
+    """Holds a snapshot of what's currently on each sign and fans out
+    changes to subscribers (the /events endpoint).
+
+    SignWriters call publish() with a plain dict. A single thread
+    running run() serializes each new snapshot once and hands the
+    same string to every subscriber, so the cost of a change doesn't
+    depend on how many dashboards are watching.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # sign name -> dict describing what's on it
+        self._snapshot = {}
+        self._version = 0
+        # (version, json, event) for the last serialized snapshot
+        self._serialized = (0, "{}", None)
+        self._subscribers = set()
+
+    def publish(self, name, snapshot):
+        with self._cond:
+            if snapshot == self._snapshot.get(name):
+                return
+            self._version += 1
+            self._snapshot = dict(self._snapshot)
+            self._snapshot[name] = snapshot
+            self._cond.notify()
+
+    def current(self):
+        """Returns JSON str of the latest serialized snapshot"""
+        return self._serialized[1]
+
+    def subscribe(self):
+        """Returns a Queue that will receive serialized events, starting
+        with the current one if there is one
+        """
+        q = Queue.Queue(maxsize=1)
+        with self._cond:
+            event = self._serialized[2]
+            if event:
+                q.put(event)
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._cond:
+            self._subscribers.discard(q)
+
+    def _serialize(self, version, snapshot):
+        data = json.dumps({ 'version' : version, 'signs' : snapshot })
+        event = "id: %d\nevent: sequence\ndata: %s\n\n" % (version, data)
+        return (version, data, event)
+
+    def run(self):
+        """Broadcaster thread"""
+        while not SHUTDOWN:
+            with self._cond:
+                if self._version == self._serialized[0]:
+                    self._cond.wait(1)
+                if self._version == self._serialized[0]:
+                    continue
+                version, snapshot = self._version, self._snapshot
+                subscribers = list(self._subscribers)
+
+            self._serialized = self._serialize(version, snapshot)
+            event = self._serialized[2]
+            LOG.debug("Broadcasting sequence version %d to %d subscribers", version, len(subscribers))
+
+            for q in subscribers:
+                # subscribers only care about the latest state, so a
+                # slow one just has its unsent event replaced
+                try:
+                    q.get_nowait()
+                except Queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(event)
+                except Queue.Full:
+                    pass
+
+        LOG.info("Exiting broadcaster")
+
+
+BROADCASTER = Broadcaster()
+
+
+class EnqueueError(Exception):
+    """Raised by queue_sequence() and queue_message() when something
+    can't be queued. code is the HTTP status it maps to, and
+    retry_after (if set) how many secs to wait before trying again.
+    """
+
+    def __init__(self, code, message, retry_after=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+def queue_sequence(seq):
+    """Validate and queue a sequence, to be run asap. Shared by the
+    web and local socket APIs.
+    """
+    if not isinstance(seq, dict) or "duration" not in seq or "messages" not in seq:
+        raise EnqueueError(500, "JSON object didn't contain 'duration' and 'messages' keys")
+    messages = seq['messages']
+    try:
+        if seq['duration'] != 'auto':
+            int(seq['duration'])
+        for key in ('max_cycle', 'cycles'):
+            if key in seq and not is_number(seq[key]):
+                raise ValueError("'%s' isn't a number" % (key,))
+        validate_signs(seq)
+        for m in messages:
+            validate_message(m)
+    except (TypeError, ValueError) as e:
+        raise EnqueueError(400, "Invalid sequence: %s" % (str(e),))
+    LOG.info("Queuing sequence containing messages: %s", ", ".join([m.get('text') for m in messages]))
+    if not SEQUENCE_QUEUE.offer(seq):
+        # queued sequences go as soon as the current one's written, so
+        # this shouldn't last long
+        raise EnqueueError(503, "Sequence queue is full", retry_after=5)
+    if RECORDER:
+        RECORDER.record_json(TRACE_ENQUEUE_SEQUENCE, seq)
+
+
+def queue_message(msg):
+    """Validate and queue a single message, to be included in the
+    default sequence of messages. Shared by the web and local socket
+    APIs.
+    """
+    if not isinstance(msg, dict) or "text" not in msg:
+        raise EnqueueError(500, "JSON object didn't contain 'text' key")
+    try:
+        validate_message(msg)
+    except ValueError as e:
+        raise EnqueueError(400, "Invalid message: %s" % (str(e),))
+    LOG.info("Queuing message: %s", msg['text'])
+    try:
+        MESSAGE_QUEUE.put_nowait(msg)
+    except Queue.Full:
+        # these only get picked up when sign_sequence() runs
+        raise EnqueueError(503, "Message queue is full", retry_after=60)
+    if RECORDER:
+        RECORDER.record_json(TRACE_ENQUEUE_MESSAGE, msg)
 
 
 class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -67,24 +644,56 @@ class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     BaseHTTPRequestHandler?
     """
 
+    timeout = HTTP_TIMEOUT
+
     def do_GET(self):
         self.dispatch()
 
+    def do_HEAD(self):
+        self.dispatch()
+
     def do_POST(self):
         self.dispatch()
 
+    # a client can go away mid-response (eg. a closed /events
+    # stream); there's nobody left to tell, so don't spew tracebacks
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        # through the logging queue (and rate limiting) rather than
+        # straight to stderr
+        LOG.info("%s - " + format, self.client_address[0], *args)
+
     def dispatch(self):
         dispatch = (
-            # urls: order matters here!
+            # urls: order matters here! a trailing slash on anything
+            # besides the root matches everything underneath it
             ('/enqueue_sequence', self.enqueue_sequence),
             ('/enqueue_message', self.enqueue_message),
+            ('/current', self.current),
+            ('/events', self.events),
+            ('/static/', self.static),
             ('/', self.frontend),
             )
 
+        path = self.path.split('?', 1)[0]
+
         handled = False
         error = None
         for prefix, handler in dispatch:
-            if self.path == prefix:
+            if path == prefix or \
+                    (prefix != '/' and prefix.endswith('/') and path.startswith(prefix)):
                 try:
                     handler()
                 except Exception as e:
@@ -94,229 +703,1461 @@ class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not handled:
             self.send_response(404)
         if error:
-            LOG.error("Error occurred in handler: %s" % (str(error,)))
+            LOG.error("Error occurred in handler: %s", error)
             self.send_response(500, "Error occurred in handler: %s" % (str(error,)))
 
-    def _get_html(self, path):
-        """Returns contents of file specified by 'path'. this caches.
+    def _accepts_gzip(self):
+        encodings = self.headers.getheader('accept-encoding') or ''
+        return 'gzip' in [e.split(';')[0].strip() for e in encodings.split(',')]
+
+    def _etag_matches(self, etag):
+        tags = self.headers.getheader('if-none-match')
+        if not tags:
+            return False
+        tags = [t.strip() for t in tags.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    def send_static_file(self, path, max_age=0):
+        """Sends the file at path from STATIC_CACHE, answering with a
+        304 if the client already has it and gzipping if the client
+        allows it.
         """
-        if not hasattr(self, "_cache"):
-            self._cache = {}
+        try:
+            entry = STATIC_CACHE.get(path)
+        except (IOError, OSError):
+            self.send_response(404)
+            self.end_headers()
+            return
 
-        if not path in self._cache:
-            f = open(path)
-            html = f.read()
-            f.close()
-            self._cache[path] = html
+        if self._etag_matches(entry.etag):
+            self.send_response(304)
+            self.send_header("ETag", entry.etag)
+            self.send_header("Cache-Control", "max-age=%d" % (max_age,))
+            self.end_headers()
+            return
+
+        body = entry.body
+        self.send_response(200)
+        self.send_header("Content-type", entry.content_type)
+        if entry.gzipped is not None:
+            self.send_header("Vary", "Accept-Encoding")
+            if self._accepts_gzip():
+                body = entry.gzipped
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", entry.etag)
+        self.send_header("Cache-Control", "max-age=%d" % (max_age,))
+        self.end_headers()
 
-        return self._cache.get(path)
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
     def frontend(self):
         """Render an html page for a frontend, so user can queue stuff
         in a browser
 
+        """
+        path = os.path.join(os.getcwd(), "frontend.html")
+        # always revalidate the page itself, which is cheap thanks to
+        # the ETag, so asset changes get picked up
+        self.send_static_file(path, max_age=0)
+
+    def static(self):
+        """Serve a bundled asset (scripts, stylesheets) from
+        STATIC_DIR
+        """
+        root = os.path.realpath(os.path.join(os.getcwd(), STATIC_DIR))
+        name = self.path.split('?', 1)[0][len('/static/'):]
+        path = os.path.realpath(os.path.join(root, name))
+        if not path.startswith(root + os.sep):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_static_file(path, max_age=3600)
+
+    def current(self):
+        """URL endpoint returning JSON describing the sequence currently
+        on the sign
+        """
+        body = BROADCASTER.current()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def events(self):
+        """URL endpoint for a Server-Sent Events stream of the sequence
+        currently on the sign. Holds the connection open until the
+        client goes away.
         """
         self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        q = BROADCASTER.subscribe()
+        try:
+            self.wfile.write("retry: 5000\n\n")
+            while not SHUTDOWN:
+                try:
+                    event = q.get(True, EVENTS_KEEPALIVE)
+                except Queue.Empty:
+                    event = ": keepalive\n\n"
+                self.wfile.write(event)
+        except socket.error:
+            LOG.debug("Event stream client %s went away", self.client_address[0])
+        finally:
+            BROADCASTER.unsubscribe(q)
+
+    def send_status(self, code, message=None, headers=()):
+        """Send a response with no body"""
+        self.send_response(code, message)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def read_post(self):
+        """Returns the parsed JSON body of a POST, or None if a response
+        has already been sent because it can't or shouldn't be accepted
+        """
+        if self.command != 'POST':
+            self.send_status(500, "GET not supported")
+            return None
 
-        path = os.path.join(os.getcwd(),"frontend.html")
-        self.wfile.write(self._get_html(path))
+        wait = RATE_LIMITER.acquire(self.client_address[0])
+        if wait:
+            LOG.info("Rate limiting %s", self.client_address[0])
+            self.send_status(429, "Too many requests",
+                             headers=[("Retry-After", str(int(wait) + 1))])
+            return None
+
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+        except ValueError:
+            self.send_status(400, "Bad Content-Length")
+            return None
+        if length < 0:
+            self.send_status(400, "Bad Content-Length")
+            return None
+        if length > MAX_POST_SIZE:
+            self.send_status(413, "Request body too large")
+            return None
+
+        try:
+            postdata = self.rfile.read(length)
+        except socket.timeout:
+            self.send_status(408, "Timed out reading request body")
+            return None
+        try:
+            data = json.loads(postdata)
+        except ValueError:
+            data = None
+        if data is None:
+            self.send_status(400, "Request body isn't valid JSON")
+        return data
 
     def enqueue_sequence(self):
         """URL endpoint for queueing a sequence of messages, to be run
         asap
         """
-        if self.command == 'POST':
-            length = int(self.headers.getheader('content-length'))
-            postdata = self.rfile.read(length)
-            seq = json.loads(postdata)
-            if "duration" in seq and "messages" in seq:
-                messages = seq['messages']
-                LOG.info("Queuing sequence containing messages: " + ", ".join([m.get('text') for m in messages]))
-                SEQUENCE_QUEUE.put(seq)
-                self.send_response(200)
-            else:
-                self.send_response(500, "JSON object didn't contain 'duration' and 'messages' keys")
-        else:
-            self.send_response(500, "GET not supported")
+        seq = self.read_post()
+        if seq is None:
+            return
+        self.send_enqueue_result(queue_sequence, seq)
 
     def enqueue_message(self):
         """URL endpoint for queueing a single message, to be included
         in the default sequence of messages
         """
-        if self.command == 'POST':
-            length = int(self.headers.getheader('content-length'))
-            postdata = self.rfile.read(length)
-            msg = json.loads(postdata)
-            if "text" in msg:
-                LOG.info("Queuing message: " + msg['text'])
-                MESSAGE_QUEUE.put(msg)
-                self.send_response(200)
-            else:
-                self.send_response(500, "JSON object didn't contain 'text' key")
-        else:
-            self.send_response(500, "GET not supported")
+        msg = self.read_post()
+        if msg is None:
+            return
+        self.send_enqueue_result(queue_message, msg)
 
+    def send_enqueue_result(self, queue_fn, obj):
+        try:
+            queue_fn(obj)
+            self.send_status(200)
+        except EnqueueError as e:
+            headers = []
+            if e.retry_after:
+                headers.append(("Retry-After", str(e.retry_after)))
+            self.send_status(e.code, str(e), headers=headers)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Handles each request in its own thread, so long-lived /events
+    streams don't block everyone else
+    """
+    daemon_threads = True
 
-def start_server(port):
-    """Start a web server on specified port in a separate thread, and
-    also start a monitor thread for SHUTDOWN signal
+
+def serve_until_shutdown(server, description):
+    """Run server until SHUTDOWN, which a separate monitor thread
+    watches for
     """
-    server = None
     def listen_for_shutdown():
         """ monitor thread for SHUTDOWN """
         while not SHUTDOWN:
             time.sleep(1)
-        LOG.info("Shutting down web server...")
+        LOG.info("Shutting down %s...", description)
         server.shutdown()
 
     threading.Thread(target=listen_for_shutdown).start()
-
-    LOG.info("Starting server on port %d" % (port,))
-    server = BaseHTTPServer.HTTPServer(('', port), HttpHandler)
     server.serve_forever(poll_interval=1)
 
 
-def display_message(sign, msg, textfile, log=True):
-    """This translates what we call a 'msg' into the sign's textfile
-    and stringfile concepts. For simplicity, messages can only have
-    one color, speed and mode (even though the protocol allows more
-    flexibility) and these are split across a pair of
-    textfile/stringfile objects.
+def start_server(port):
+    """Start a web server on specified port in a separate thread, and
+    also start a monitor thread for SHUTDOWN signal
+    """
+    LOG.info("Starting server on port %d", port)
+    server = ThreadingHTTPServer(('', port), HttpHandler)
+    serve_until_shutdown(server, "web server")
+
+
+class LocalHandler(SocketServer.BaseRequestHandler):
+    """Handles a connection to the local socket. Each line sent is a
+    JSON object with either a 'message' or a 'sequence' key, queued
+    just like a POST to /enqueue_message or /enqueue_sequence would
+    be, and answered with a line like {"ok": true} or {"ok": false,
+    "code": 503, "error": "...", "retry_after": 60}. Connections can
+    be kept open for as many requests as needed.
+    """
+
+    def handle(self):
+        sock = self.request
+        try:
+            try:
+                for line in read_lines(sock, max_length=MAX_POST_SIZE):
+                    send_line(sock, self.enqueue(line))
+            except LineTooLong:
+                # no telling where the next request starts, so that's
+                # it for this connection
+                send_line(sock, { 'ok' : False, 'code' : 413,
+                                  'error' : "Request too large",
+                                  'retry_after' : None })
+        except socket.error:
+            pass
+
+    def enqueue(self, line):
+        try:
+            if len(line) > MAX_POST_SIZE:
+                raise EnqueueError(413, "Request too large")
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise EnqueueError(400, "Request isn't valid JSON")
+            if isinstance(request, dict) and 'sequence' in request:
+                queue_sequence(request['sequence'])
+            elif isinstance(request, dict) and 'message' in request:
+                queue_message(request['message'])
+            else:
+                raise EnqueueError(400, "Request needs a 'message' or 'sequence' key")
+        except EnqueueError as e:
+            return { 'ok' : False, 'code' : e.code, 'error' : str(e),
+                     'retry_after' : e.retry_after }
+        except Exception as e:
+            # answer rather than dropping the connection, so the client
+            # doesn't think it never got through and send it again
+            LOG.error("Error occurred in local handler: %s", e)
+            return { 'ok' : False, 'code' : 500,
+                     'error' : "Error occurred in handler: %s" % (e,),
+                     'retry_after' : None }
+        return { 'ok' : True }
+
+
+class LocalServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """Remove a socket left at path by a previous run. Returns False if
+    there's something else there, which shouldn't be touched.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return True
+    if not stat.S_ISSOCK(mode):
+        return False
+    os.unlink(path)
+    return True
+
+
+def start_local_server(path):
+    """Listen on a Unix domain socket at path for local producers, in
+    a separate thread, until SHUTDOWN. Anyone who can write to the
+    socket file can queue messages, and they aren't rate limited.
+    Anything left at path should be cleared with remove_stale_socket()
+    first.
+    """
+    server = LocalServer(path, LocalHandler)
+    LOG.info("Listening for local producers on %s", path)
+    serve_until_shutdown(server, "local socket server")
+    os.unlink(path)
+
+
+def validate_message(msg):
+    """Raises ValueError if msg isn't something we can display"""
+    if not isinstance(msg, dict):
+        raise ValueError("Message isn't a JSON object")
+    text = msg.get('text')
+    if not isinstance(text, basestring):
+        raise ValueError("Message doesn't have a 'text' string")
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        raise ValueError("Message text has characters the sign can't display")
+    for key, codes in (('mode', MODES), ('color', COLORS), ('speed', SPEEDS)):
+        if key in msg and msg[key] not in codes:
+            raise ValueError("Unknown %s: %s" % (key, msg[key]))
+    if 'priority' in msg and not is_number(msg['priority']):
+        raise ValueError("Message 'priority' isn't a number")
+    validate_signs(msg)
+
+
+def validate_signs(item):
+    """Raises ValueError if a message or sequence has a 'sign' key that
+    isn't a sign name or a list of them
+    """
+    signs = item.get('sign')
+    if signs is None or isinstance(signs, basestring):
+        return
+    if not isinstance(signs, list) or not all(isinstance(s, basestring) for s in signs):
+        raise ValueError("'sign' isn't a sign name or a list of names")
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+FIELD_PATTERN = re.compile(r"\{(\w+)\}")
+
+
+def register_fields(names):
+    """Assign a STRING file label to each live field name. Has to
+    happen before any messages are encoded.
     """
+    names = sorted(names)
+    if len(names) > NUM_STRINGFILES:
+        LOG.info("WARNING: Only %d live fields are supported, ignoring: %s", NUM_STRINGFILES, ", ".join(names[NUM_STRINGFILES:]))
+    FIELDS.clear()
+    FIELDS.update(zip(names, STRING_LABELS))
 
-    if log:
-        LOG.info("Displaying msg: %s" % (msg['text'],))
+
+def expand_fields(text):
+    """Replace {name} placeholders for live fields with the control
+    code that calls up the field's STRING file. Anything else in
+    braces is left alone.
+    """
+    def replace(match):
+        label = FIELDS.get(match.group(1))
+        if label is None:
+            return match.group(0)
+        return alphasign.String(label=label).call()
+    return FIELD_PATTERN.sub(replace, text)
+
+
+def fill_fields(text):
+    """Replace {name} placeholders for live fields with their current
+    values, ie. the text as it appears on the sign
+    """
+    def replace(match):
+        label = FIELDS.get(match.group(1))
+        if label is None:
+            return match.group(0)
+        return FIELD_VALUES.get(label, "")
+    return FIELD_PATTERN.sub(replace, text)
+
+
+def _encode_message(msg):
+    validate_message(msg)
 
     text = ""
     if "color" in msg:
         text += "%s" % (get_color(msg['color'],))
     if "speed" in msg:
         text += "%s" % (get_speed(msg['speed'],))
-    text += msg['text']
+    text += expand_fields(msg['text'])
 
     # default mode
     mode = 'ROTATE'
     if 'mode' in msg:
         mode = msg['mode']
 
-    # only write if something changed
-    if textfile.mode != get_mode(mode) or textfile.data != text:
-        LOG.debug("textfile changed, writing to sign")
-        textfile.mode = get_mode(mode)
-        textfile.data = text
-        sign.write(textfile)
+    return (get_mode(mode), text)
+
+
+def encode_message(msg):
+    """This translates what we call a 'msg' into what gets written to
+    one of the sign's textfiles, returning a (mode, data) tuple. For
+    simplicity, messages can only have one color, speed and mode (even
+    though the protocol allows more flexibility).
+
+    Raises ValueError for messages that can't be displayed. Results
+    are cached, so identical messages give back the very same tuple
+    and checking one against what's on the sign is usually just an
+    identity check.
+    """
+    key = (msg.get('text'), msg.get('color'), msg.get('speed'), msg.get('mode'))
+    return MESSAGE_CACHE.get(key, lambda: _encode_message(msg))
+
+
+def encode_frame(label, value):
+    """Returns the packet, as a str, that writes value (a (mode, data)
+    tuple from encode_message()) to the textfile with label
+    """
+    def make():
+        mode, data = value
+        return str(alphasign.Text(data, label=label, size=125, mode=mode))
+    return FRAME_CACHE.get((label, value), make)
+
+
+def encode_string_frame(label, data):
+    """Returns the packet, as a str, that writes data to the STRING
+    file with label
+    """
+    return str(alphasign.String(data, label=label, size=STRING_SIZE))
+
+
+BLANK = encode_message({ 'mode' : 'HOLD', 'text' : '' })
+
+
+def estimate_display_time(msg):
+    """Returns roughly how many secs the sign takes to show msg once,
+    based on its mode, speed and length. See the TIMING constants.
+    """
+    length = len(fill_fields(msg['text']))
+    factor = SPEED_FACTORS.get(msg.get('speed'), 1.0)
+    mode = msg.get('mode', 'ROTATE')
+
+    if mode in SCROLLING_MODES:
+        # enters at the right edge and has to leave at the left
+        return (length + SIGN_WIDTH) * SCROLL_CHAR_TIME * factor
+
+    pages = max(1, (length + SIGN_WIDTH - 1) // SIGN_WIDTH)
+    if mode == 'HOLD':
+        return pages * HOLD_TIME
+    return pages * (HOLD_TIME + TRANSITION_TIME * factor)
+
+
+def cycle_time(messages):
+    """Returns roughly how many secs the sign takes to get through
+    messages once
+    """
+    return sum([estimate_display_time(m) for m in messages])
+
+
+def plan_sequence(sequence):
+    """Works out what to show for a sequence, returning a tuple of
+    (messages, duration in secs, cycle time in secs).
+
+    Sequences can have these optional keys, on top of 'duration' and
+    'messages':
+
+    'max_cycle' : secs; if the messages take longer than this to cycle
+                  through, drop some to fit, keeping those with the
+                  highest 'priority' (a number, default 0) in their
+                  original order
+    'cycles'    : with 'duration' : 'auto', how many times to show the
+                  messages (default 1)
+
+    A 'duration' of 'auto' means as long as 'cycles' times through the
+    messages takes.
+    """
+    messages = sequence.get('messages', [])
+    times = []
+    for m in messages:
+        try:
+            times.append(estimate_display_time(m))
+        except (KeyError, TypeError):
+            times.append(0)
+
+    budget = None
+    if sequence.get('max_cycle'):
+        try:
+            budget = float(sequence['max_cycle'])
+        except (TypeError, ValueError):
+            LOG.error("Bad max_cycle in sequence, ignoring it")
+
+    def priority(m):
+        try:
+            return float(m.get('priority', 0))
+        except (AttributeError, TypeError, ValueError):
+            return 0
+
+    if budget:
+        by_priority = sorted(range(len(messages)),
+                             key=lambda i: -priority(messages[i]))
+        keep = set()
+        total = 0
+        for i in by_priority:
+            if total + times[i] <= budget:
+                keep.add(i)
+                total += times[i]
+        if len(keep) < len(messages):
+            LOG.info("Dropping %d message(s) to fit a %ds cycle", len(messages) - len(keep), budget)
+            messages = [messages[i] for i in sorted(keep)]
+            times = [times[i] for i in sorted(keep)]
+
+    cycle = sum(times)
+
+    duration = sequence.get('duration', 60)
+    try:
+        if duration == 'auto':
+            duration = max(MIN_DURATION, int(cycle * float(sequence.get('cycles', 1)) + 0.5))
+        else:
+            duration = int(duration)
+    except (TypeError, ValueError):
+        LOG.error("Bad duration/cycles in sequence, using 60 secs")
+        duration = 60
+
+    return (messages, duration, cycle)
+
+
+def publish_sequence(name, messages, duration, active=True):
+    """Tell BROADCASTER what is now on the sign called name, with live
+    fields filled in; call again when they change
+    """
+    keys = ('mode', 'color', 'speed')
+    published = []
+    for m in messages:
+        msg = dict((k, m[k]) for k in keys if k in m)
+        msg['text'] = fill_fields(m.get('text', ''))
+        published.append(msg)
+    BROADCASTER.publish(name, {
+            'active' : active,
+            'duration' : duration,
+            'cycle_time' : int(cycle_time(messages) + 0.5),
+            'messages' : published,
+            })
+
+
+def routing_key(item):
+    """Returns a hashable value representing which signs item is for"""
+    signs = item.get('sign')
+    if isinstance(signs, basestring):
+        signs = [signs]
+    if signs is not None:
+        signs = tuple(sorted(signs))
+    return signs
+
+
+def is_routed_to(item, name):
+    """Returns True if a message or sequence should go to the sign
+    called name. Either can have a 'sign' key holding a sign name or a
+    list of them; without one, it goes to every sign.
+    """
+    signs = item.get('sign')
+    if signs is None:
+        return True
+    if isinstance(signs, basestring):
+        signs = [signs]
+    # anything else is a mistake in a config module (the APIs check for
+    # it); it can't be meant for any sign
+    return isinstance(signs, (list, tuple)) and name in signs
+
+
+class SignWriter(object):
+    """Owns a single sign: its textfiles, what's currently written to
+    them, and a worker thread that does the (slow) serial I/O.
+
+    sign_loop() generates each sequence once and submits it to every
+    SignWriter, so an additional sign only costs its own writes.
+
+    What's on the sign is modeled as 'state', a dict of textfile label
+    -> (mode, data), plus the string of labels in the run sequence and
+    'strings', a dict of STRING file label -> data.
+    """
+
+    def __init__(self, name, sign):
+        self.name = name
+        self.sign = sign
+        # only the latest submission matters; see submit()
+        self.inbox = Queue.Queue(maxsize=1)
+        # held while writing, since live fields are updated from
+        # another thread
+        self.lock = threading.Lock()
+        self.textfiles = []
+        self.stringfiles = []
+        self.files = {}
+        self.state = {}
+        self.strings = {}
+        self.run_labels = ""
+        # args to publish_sequence() for what's on the sign
+        self.published = None
+
+    def submit(self, messages, duration, active=True):
+        """Hand messages to the worker thread, replacing anything it
+        hasn't gotten to yet
+        """
+        item = (messages, duration, active)
+        while True:
+            try:
+                self.inbox.put_nowait(item)
+                return
+            except Queue.Full:
+                try:
+                    self.inbox.get_nowait()
+                except Queue.Empty:
+                    pass
+
+    def make_files(self):
+        """Create textfile and stringfile objects and the matching
+        blank state
+        """
+        self.textfiles = []
+        for label in TEXT_LABELS:
+            self.textfiles.append(alphasign.Text("",
+                                                 size=125,
+                                                 label=label,
+                                                 mode=get_mode("HOLD")))
+
+        self.stringfiles = []
+        for label in STRING_LABELS:
+            self.stringfiles.append(alphasign.String("", label=label, size=STRING_SIZE))
+
+        self.files = dict((t.label, t) for t in self.textfiles)
+        self.state = dict((t.label, BLANK) for t in self.textfiles)
+        self.strings = dict((s.label, "") for s in self.stringfiles)
+        self.run_labels = self.textfiles[0].label
+
+    def setup(self):
+        """Allocate the sign's files and blank them out"""
+        with self.lock:
+            self.make_files()
+
+            self.sign.allocate(self.textfiles + self.stringfiles)
+
+            self.sign.set_run_sequence([self.files[l] for l in self.run_labels])
+
+            for f in self.textfiles + self.stringfiles:
+                self.sign.write(f)
+
+    def state_hash(self):
+        """Returns a digest of the current state, so two parties can
+        cheaply check they agree on what's on the sign
+        """
+        return hashlib.md5(json.dumps([self.run_labels,
+                                       sorted(self.state.items()),
+                                       sorted(self.strings.items())])).hexdigest()
+
+    def diff(self, state, run_labels):
+        """Returns (changes, run_labels) needed to get from the current
+        state to the one given: a dict of only the textfiles that
+        differ, and the new run labels, or None if they're unchanged.
+        """
+        changes = {}
+        for label, value in state.iteritems():
+            if self.state.get(label) != value:
+                changes[label] = value
+        if run_labels is None or run_labels == self.run_labels:
+            run_labels = None
+        return (changes, run_labels)
+
+    def update(self, state, run_labels=None):
+        """Write whatever differs between state/run_labels and what's
+        on the sign
+        """
+        with self.lock:
+            changes, run_labels = self.diff(state, run_labels)
+
+            if run_labels is not None:
+                LOG.debug("Re-setting run sequence for sign %s", self.name)
+                self.sign.set_run_sequence([self.files[l] for l in run_labels])
+                self.run_labels = run_labels
+
+            for label in sorted(changes.keys()):
+                LOG.debug("textfile %s changed, writing to sign %s", label, self.name)
+                self.sign.write(encode_frame(label, changes[label]))
+                self.state[label] = changes[label]
+
+    def diff_strings(self, strings):
+        """Returns dict of only the STRING files in strings that differ
+        from what's on the sign
+        """
+        return dict((label, data) for label, data in strings.iteritems()
+                    if self.strings.get(label) != data)
+
+    def update_strings(self, strings):
+        """Write STRING files (label -> data) that changed. These are
+        tiny, so live fields can be refreshed often without rewriting
+        the textfiles that refer to them.
+        """
+        with self.lock:
+            if not self.stringfiles:
+                # not set up yet; run() catches up once it is
+                return
+            for label, data in sorted(self.diff_strings(strings).items()):
+                LOG.debug("string %s changed, writing to sign %s", label, self.name)
+                self.sign.write(encode_string_frame(label, data))
+                self.strings[label] = data
+
+    def display(self, messages):
+        """Writes the messages routed to this sign, touching only the
+        textfiles that changed. Returns the messages displayed.
+        """
+        routed = []
+        values = []
+        for msg in messages:
+            if not is_routed_to(msg, self.name):
+                continue
+            try:
+                values.append(encode_message(msg))
+                routed.append(msg)
+            except ValueError as e:
+                LOG.error("Skipping message for sign %s: %s", self.name, e)
+        messages = routed
+
+        if not messages:
+            self.update(dict((t.label, BLANK) for t in self.textfiles))
+            return messages
+
+        labels = self.assign_labels(values)
+
+        run_labels = []
+        for msg, value in zip(messages, values):
+            if value not in labels:
+                LOG.info("WARNING: Got %d distinct messages for sign %s, which exceeds limit of %d. Truncating.", len(set(values)), self.name, NUM_TEXTFILES)
+                break
+            if len(run_labels) == MAX_RUN_LENGTH:
+                LOG.info("WARNING: Got %d messages for sign %s, which exceeds limit of %d. Truncating.", len(messages), self.name, MAX_RUN_LENGTH)
+                break
+            run_labels.append(labels[value])
+        messages = messages[:len(run_labels)]
+
+        for msg in messages:
+            LOG.info("Displaying msg: %s", msg['text'])
 
+        state = dict((label, value) for value, label in labels.iteritems())
+        self.update(state, "".join(run_labels))
 
-def check_if_active(currently_active, active_fn, sign, textfiles):
+        return messages
+
+    def assign_labels(self, values):
+        """Returns dict of value -> textfile label to put it in, for
+        each distinct value (as many as there are textfiles for), so
+        that a message repeated in the sequence is only stored and
+        written once. Values already on the sign stay where they are,
+        so inserting a message doesn't rewrite all the ones after it.
+        """
+        on_sign = {}
+        for label in TEXT_LABELS:
+            on_sign.setdefault(self.state.get(label), label)
+
+        labels = {}
+        for value in values:
+            if value in on_sign:
+                labels[value] = on_sign[value]
+
+        used = set(labels.values())
+        free = iter([l for l in TEXT_LABELS if l not in used])
+        for value in values:
+            if value not in labels:
+                try:
+                    labels[value] = free.next()
+                except StopIteration:
+                    break
+
+        return labels
+
+    def clear(self):
+        """Blank out the sign"""
+        self.update(dict((t.label, BLANK) for t in self.textfiles))
+
+    def run(self):
+        """Worker thread for this sign"""
+        try:
+            self.setup()
+            self.update_strings(dict(FIELD_VALUES))
+        except Exception as e:
+            LOG.error("Error setting up sign %s: %s", self.name, e)
+            return
+
+        while not SHUTDOWN:
+            try:
+                messages, duration, active = self.inbox.get(True, 1)
+            except Queue.Empty:
+                continue
+
+            try:
+                if active:
+                    displayed = self.display(messages)
+                else:
+                    self.clear()
+                    displayed = []
+                self.published = (self.name, displayed, duration, active)
+                publish_sequence(*self.published)
+            except Exception as e:
+                LOG.error("Error writing to sign %s: %s", self.name, e)
+
+        LOG.info("Exiting writer for sign %s", self.name)
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+def read_lines(sock, idle_fn=None, max_length=None):
+    """Generator yielding lines from a socket, for the line-delimited
+    JSON used between the central process and agents. Checks for
+    SHUTDOWN every second, calling idle_fn(idle_secs) while nothing's
+    arriving; idle_fn can raise socket.timeout to give up. Raises
+    LineTooLong once more than max_length bytes arrive without a
+    newline.
+    """
+    sock.settimeout(1)
+    buf = ""
+    idle_since = time.time()
+    while not SHUTDOWN:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            if idle_fn:
+                idle_fn(time.time() - idle_since)
+            continue
+        if not data:
+            raise socket.error("Connection closed")
+        idle_since = time.time()
+        buf += data
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            yield line
+        if max_length and len(buf) > max_length:
+            raise LineTooLong("Line longer than %d bytes" % (max_length,))
+
+
+def send_line(sock, obj):
+    sock.sendall(json.dumps(obj) + "\n")
+
+
+def state_to_json(state):
+    return dict((label, list(value)) for label, value in state.iteritems())
+
+
+def state_from_json(state):
+    return dict((str(label), tuple(value)) for label, value in state.iteritems())
+
+
+class RemoteSignWriter(SignWriter):
+    """A sign attached to a 'simplesign.py --agent' process on another
+    machine. Sequences are turned into state and diffed here, same as
+    for a local sign, but the changes are sent to the agent over its
+    connection rather than written to a serial port.
+
+    These live as long as the process, across agent reconnects, so
+    the state here is always what the agent should have.
+    """
+
+    def __init__(self, name):
+        SignWriter.__init__(self, name, None)
+        self.conn = None
+        self.make_files()
+
+    def setup(self):
+        """Nothing to allocate locally; the agent does that"""
+        pass
+
+    def _send(self, obj):
+        """Send to the agent, if there is one. Call with self.lock held."""
+        if self.conn is None:
+            return
+        try:
+            send_line(self.conn, obj)
+        except socket.error as e:
+            LOG.info("Lost agent for sign %s: %s", self.name, e)
+            # end the connection for both sides, so the agent reconnects
+            # and catches up rather than staying connected but stale
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.conn = None
+
+    def sync(self):
+        """Send the complete state. Call with self.lock held."""
+        LOG.info("Sending full state to agent for sign %s", self.name)
+        self._send({ 'type' : 'sync',
+                     'files' : state_to_json(self.state),
+                     'strings' : self.strings,
+                     'run' : self.run_labels,
+                     'hash' : self.state_hash() })
+
+    def attach(self, conn, agent_hash):
+        """Start sending to a newly connected agent, which already has
+        the state matching agent_hash
+        """
+        with self.lock:
+            self.conn = conn
+            if agent_hash != self.state_hash():
+                self.sync()
+
+    def detach(self, conn):
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+
+    def update(self, state, run_labels=None):
+        with self.lock:
+            changes, run_labels = self.diff(state, run_labels)
+            if not changes and run_labels is None:
+                return
+            self.state.update(changes)
+            msg = { 'type' : 'diff', 'files' : state_to_json(changes) }
+            if run_labels is not None:
+                self.run_labels = run_labels
+                msg['run'] = run_labels
+            msg['hash'] = self.state_hash()
+            self._send(msg)
+
+    def update_strings(self, strings):
+        with self.lock:
+            changes = self.diff_strings(strings)
+            if not changes:
+                return
+            self.strings.update(changes)
+            self._send({ 'type' : 'strings',
+                         'strings' : changes,
+                         'hash' : self.state_hash() })
+
+
+class AgentHandler(SocketServer.BaseRequestHandler):
+    """Handles a connection from a sign agent: it says hello with its
+    sign's name and state hash, and from then on gets diffs from that
+    sign's RemoteSignWriter. The agent asks for a resync if it ever
+    finds its state has drifted.
+    """
+
+    writer = None
+    last_ping = 0
+
+    def ping(self, idle):
+        """Let the agent know we're still here"""
+        if self.writer and idle >= AGENT_PING and time.time() - self.last_ping >= AGENT_PING:
+            with self.writer.lock:
+                send_line(self.request, { 'type' : 'ping' })
+            self.last_ping = time.time()
+
+    def handle(self):
+        sock = self.request
+        try:
+            lines = read_lines(sock, idle_fn=self.ping)
+            hello = json.loads(lines.next())
+            if hello.get('type') != 'hello' or not hello.get('name'):
+                LOG.error("Bad hello from agent at %s", self.client_address[0])
+                return
+            LOG.info("Agent for sign %s connected from %s", hello['name'], self.client_address[0])
+            writer = self.server.writer_for(hello['name'])
+            if writer is None:
+                LOG.error("Agent at %s wants sign %s, which is a local sign",
+                          self.client_address[0], hello['name'])
+                return
+            self.writer = writer
+            self.writer.attach(sock, hello.get('hash'))
+
+            for line in lines:
+                msg = json.loads(line)
+                if msg.get('type') == 'resync':
+                    with self.writer.lock:
+                        self.writer.sync()
+        except (socket.error, StopIteration, ValueError) as e:
+            LOG.info("Agent connection from %s ended: %s", self.client_address[0], e)
+        finally:
+            if self.writer:
+                self.writer.detach(sock)
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Accepts connections from sign agents, creating (and handing to
+    sign_loop) a RemoteSignWriter for each sign name the first time
+    it's seen
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, writers):
+        SocketServer.TCPServer.__init__(self, address, AgentHandler)
+        self.writers = writers
+        self.lock = threading.Lock()
+
+    def writer_for(self, name):
+        """Returns the RemoteSignWriter for name, or None if it's the
+        name of a local sign
+        """
+        with self.lock:
+            for writer in self.writers:
+                if writer.name == name:
+                    if not isinstance(writer, RemoteSignWriter):
+                        return None
+                    return writer
+            writer = RemoteSignWriter(name)
+            threading.Thread(target=writer.run).start()
+            # catch it up with everyone else
+            if LAST_SUBMISSION:
+                writer.submit(*LAST_SUBMISSION)
+            self.writers.append(writer)
+            return writer
+
+
+def start_agent_server(port, writers):
+    """Listen for sign agents on port, in a separate thread, until
+    SHUTDOWN
+    """
+    server = AgentServer(('', port), writers)
+    LOG.info("Listening for sign agents on port %d", port)
+    serve_until_shutdown(server, "agent server")
+
+
+def run_agent(host, port, writer):
+    """Main loop for 'simplesign.py --agent': keep a connection open to
+    the central process and apply the diffs it sends to the local
+    sign, reconnecting (and resyncing if needed) when it drops
+    """
+    writer.setup()
+
+    backoff = 1
+    while not SHUTDOWN:
+        try:
+            sock = socket.create_connection((host, port), 10)
+        except socket.error as e:
+            LOG.info("Couldn't connect to %s:%d (%s), retrying in %d secs", host, port, e, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+
+        LOG.info("Connected to %s:%d", host, port)
+
+        def check_idle(idle):
+            if idle >= AGENT_PING * 3:
+                raise socket.timeout("Nothing from %s:%d in %d secs" % (host, port, idle))
+
+        try:
+            send_line(sock, { 'type' : 'hello', 'name' : writer.name, 'hash' : writer.state_hash() })
+            for line in read_lines(sock, idle_fn=check_idle):
+                # it's talking to us, so it's worth reconnecting quickly
+                backoff = 1
+                msg = json.loads(line)
+                if msg.get('type') not in ('sync', 'diff', 'strings'):
+                    continue
+                if 'files' in msg:
+                    writer.update(state_from_json(msg['files']), msg.get('run') and str(msg['run']))
+                if 'strings' in msg:
+                    writer.update_strings(dict((str(l), d) for l, d in msg['strings'].iteritems()))
+                if writer.state_hash() != msg.get('hash'):
+                    LOG.info("State doesn't match central's, asking for resync")
+                    send_line(sock, { 'type' : 'resync' })
+        except (socket.error, ValueError) as e:
+            LOG.info("Connection to %s:%d lost: %s", host, port, e)
+        finally:
+            sock.close()
+
+        # eg. if it's turning us away, don't hammer it
+        if not SHUTDOWN:
+            LOG.info("Reconnecting in %d secs", backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    LOG.info("Exiting agent")
+
+
+def field_loop(writers, fields):
+    """Worker loop that keeps live fields up to date. fields is a dict
+    of name -> (function, refresh interval in secs); each function is
+    called on its own schedule, and only values that changed are
+    written to the signs' STRING files.
+    """
+    next_update = dict((name, 0) for name in fields)
+
+    while not SHUTDOWN:
+        now = time.time()
+        changed = {}
+        for name, (fn, interval) in fields.items():
+            if name not in FIELDS or now < next_update[name]:
+                continue
+            next_update[name] = now + interval
+            try:
+                value = str(fn())[:STRING_SIZE]
+            except Exception as e:
+                LOG.error("Error updating live field %s: %s", name, e)
+                continue
+            label = FIELDS[name]
+            if FIELD_VALUES.get(label) != value:
+                FIELD_VALUES[label] = value
+                changed[label] = value
+                if RECORDER:
+                    try:
+                        RECORDER.record_json(TRACE_FIELDS, { name : value })
+                    except Exception as e:
+                        # eg. bytes that aren't UTF-8
+                        LOG.error("Error recording live field %s: %s", name, e)
+
+        if changed:
+            for writer in list(writers):
+                try:
+                    writer.update_strings(changed)
+                except Exception as e:
+                    LOG.error("Error writing live fields to sign %s: %s", writer.name, e)
+                if writer.published:
+                    publish_sequence(*writer.published)
+
+        time.sleep(1)
+
+    LOG.info("Exiting live field loop")
+
+
+def check_if_active(currently_active, active_fn, writers):
     """Returns bool for new active status; when switching to inactive
-    mode, clear out the sign. """
+    mode, clear out the signs. """
+    global LAST_SUBMISSION
     # sleep and then skip to next iteration if not active
     try:
         if not active_fn():
             if currently_active:
                 LOG.info("Going into inactive mode, sleeping...")
-                # clear sign while inactive
-                for t in textfiles:
-                    display_message(sign, { 'mode' : t.mode, 'text' : '' }, t)
+                # clear signs while inactive
+                LAST_SUBMISSION = ([], 0, False)
+                for writer in list(writers):
+                    writer.submit(*LAST_SUBMISSION)
             time.sleep(1)
             return False
     except Exception as e:
-        LOG.error("Error in is_active(): %s" % (str(e),))
+        LOG.error("Error in is_active(): %s", e)
 
     if not currently_active:
         LOG.info("Waking up from inactive mode.")
     return True
 
 
-def sleep_for(sleeptime):
-    LOG.info("Sleeping for %d secs..." % (sleeptime,))
-    start = time.time()
-    # only sleep for 1s at a time so we can respond to stuff
-    while time.time() - start < sleeptime \
-            and not SHUTDOWN \
-            and SEQUENCE_QUEUE.empty():
-        time.sleep(1)
-    LOG.info("Woke up!")
+class WorkerError(Exception):
+    pass
 
 
-def sign_loop(sign, module):
-    """Main worker loop that feeds sequences to the sign.
-    """
-    # there are 93 valid labels (see p. 50 of docs)
-    valid_labels = iter([chr(x) for x in range(0x20, 0x7E + 1) if x != 0x30 and x != 0x3F])
+def _drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except Queue.Empty:
+            return items
 
-    textfiles = []
-    for i in range(NUM_TEXTFILES):
-        textfiles.append(alphasign.Text("",
-                                        size=125,
-                                        label="%s" % (valid_labels.next(),),
-                                        mode=get_mode("HOLD")))
 
-    sign.allocate(textfiles)
+def worker_main(module, conn, parent_conn, refresh, log_queue):
+    """Runs in the worker process: answers requests from WorkerModule
+    by calling module's functions. ctx['message_queue'] is a local
+    queue, fed with the messages shipped over with each request.
+    """
+    # Ctrl-C is for the main process to deal with
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # otherwise we'd never see EOF when the main process closes its end
+    parent_conn.close()
+    # the log writer thread didn't come along, so send records back to
+    # the main process to be logged there
+    logging.getLogger().handlers = [QueueHandler(log_queue, eager=True)]
+
+    message_queue = Queue.Queue()
+    ctx = { 'message_queue' : message_queue, 'refresh' : refresh.set }
+    is_active = getattr(module, "is_active", lambda: True)
+    last = None
 
-    run_sequence = textfiles[0:1]
+    while True:
+        try:
+            request, arg = conn.recv()
+        except EOFError:
+            break
+        try:
+            if request == 'sign_sequence':
+                for msg in arg:
+                    message_queue.put(msg)
+                result = module.sign_sequence(ctx)
+                if result is last and result is not None:
+                    # no need to send it all back again
+                    reply = ('unchanged', None)
+                else:
+                    reply = ('ok', result)
+                last = result
+            elif request == 'is_active':
+                reply = ('ok', is_active())
+            elif request == 'drain':
+                reply = ('ok', _drain(message_queue))
+            else:
+                reply = ('error', "Unknown request %s" % (request,))
+            conn.send(reply)
+        except Exception as e:
+            LOG.exception("Error in worker process")
+            conn.send(('error', str(e)))
+
+
+class WorkerModule(object):
+    """Stands in for the config module in sign_loop (with --isolate),
+    running its sign_sequence() and is_active() in a separate process.
+    That keeps CPU-heavy parsing from starving the web server and sign
+    writer threads, and lets a call that hangs be killed after timeout
+    secs. The worker is replaced after max_calls calls to
+    sign_sequence(), in case it's leaking; that throws away any state
+    the module keeps (fetched sources, pooled messages...), so it's
+    off by default.
+
+    After a call times out or the worker dies, the last sequence is
+    kept, and a new worker's sequences only replace it once they're
+    non-empty and not a 'placeholder' one.
+
+    The sequence comes back pickled, so the module has to return plain
+    data; returning the same object as last time still means nothing
+    changed.
+    """
 
-    sign.set_run_sequence(run_sequence)
+    def __init__(self, module, timeout=WORKER_TIMEOUT, max_calls=WORKER_MAX_CALLS):
+        self.module = module
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self.lock = threading.Lock()
+        self.process = None
+        self.conn = None
+        self.calls = 0
+        self.last = None
+        # whether the current worker has yet to come up with a
+        # sequence worth replacing self.last with
+        self.fresh = False
+        # set by the worker's ctx['refresh']
+        self.refresh = multiprocessing.Event()
+        self.on_refresh = REFRESH.set
+        threading.Thread(target=self.watch_refresh).start()
+        # log records from the worker; a new queue for each worker, as
+        # killing one can leave its queue unusable
+        self.log_queue = None
+        threading.Thread(target=self.forward_logs).start()
+
+    def watch_refresh(self):
+        while not SHUTDOWN:
+            if self.refresh.wait(1):
+                self.refresh.clear()
+                self.on_refresh()
 
-    for t in textfiles:
-        sign.write(t)
+    def forward_logs(self):
+        while not SHUTDOWN:
+            log_queue = self.log_queue
+            if not log_queue:
+                time.sleep(1)
+                continue
+            try:
+                record = log_queue.get(True, 1)
+            except (Queue.Empty, IOError, EOFError):
+                continue
+            logging.getLogger(record.name).handle(record)
+
+    def start(self):
+        conn, child_conn = multiprocessing.Pipe()
+        self.log_queue = multiprocessing.Queue(LOG_QUEUE_SIZE)
+        self.process = multiprocessing.Process(target=worker_main,
+                                               args=(self.module, child_conn, conn,
+                                                     self.refresh, self.log_queue))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        self.calls = 0
+        # a new worker starts from scratch, so keep showing what the
+        # old one came up with until it's caught up
+        self.fresh = True
+        LOG.info("Started worker process %d", self.process.pid)
+
+    def stop(self):
+        """Shut the worker down, hanging on to any messages it hasn't
+        used yet
+        """
+        try:
+            for msg in self._call('drain', None)[1]:
+                MESSAGE_QUEUE.put_nowait(msg)
+        except (WorkerError, Queue.Full) as e:
+            LOG.info("WARNING: Lost messages queued in worker process: %s", e)
+        if self.process:
+            self.conn.close()
+            self.process.join(5)
+            self.kill()
+
+    def kill(self):
+        if self.process and self.process.is_alive():
+            LOG.info("Killing worker process %d", self.process.pid)
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+
+    def _call(self, request, arg):
+        if not self.process:
+            self.start()
+        try:
+            self.conn.send((request, arg))
+            if not self.conn.poll(self.timeout):
+                raise WorkerError("%s() took longer than %d secs" % (request, self.timeout))
+            status, result = self.conn.recv()
+        except (EOFError, IOError) as e:
+            self.kill()
+            raise WorkerError("Worker process died: %s" % (str(e),))
+        except WorkerError:
+            self.kill()
+            raise
+        if status == 'error':
+            raise WorkerError(result)
+        return (status, result)
+
+    def sign_sequence(self, ctx):
+        self.on_refresh = ctx['refresh']
+        with self.lock:
+            try:
+                status, result = self._call('sign_sequence', _drain(ctx['message_queue']))
+            except WorkerError as e:
+                LOG.error("Error running sign_sequence() in worker: %s", e)
+                return self.last
+            if status != 'unchanged':
+                if self.fresh and self.last and \
+                        (not result or result.get('placeholder')):
+                    LOG.debug("New worker isn't ready yet, keeping last sequence")
+                else:
+                    self.last = result
+                    self.fresh = False
+            result = self.last
+            self.calls += 1
+            if self.max_calls and self.calls >= self.max_calls:
+                LOG.info("Recycling worker process %d", self.process.pid)
+                self.stop()
+        return result
+
+    def is_active(self):
+        with self.lock:
+            return self._call('is_active', None)[1]
+
+
+def plan(sequence):
+    """plan_sequence(), logging how long the sequence takes"""
+    messages, duration, cycle = plan_sequence(sequence)
+    if cycle:
+        LOG.info("Sequence takes about %ds to cycle through, showing it for %ds (%.1f times)", cycle, duration, duration / cycle)
+        if duration < cycle:
+            LOG.info("WARNING: Sequence will be cut off before all of it is shown")
+    return (messages, duration)
+
+
+def sign_loop(writers, module):
+    """Main worker loop that generates sequences and hands them to the
+    SignWriters.
+
+    A queued sequence pre-empts the generated one on the signs it's
+    routed to, which are then held until it's run its course; the
+    other signs carry on getting sign_sequence()'s updates.
+    """
+    global LAST_SUBMISSION
 
     is_active = getattr(module, "is_active", lambda: True)
 
     active = True
 
+    # the last sequence from sign_sequence() that the signs were given;
+    # getting the same object back means nothing changed
+    generated = None
+    planned = ([], 60)
+    next_refresh = 0
+
+    # sign name -> time until which it's showing a queued sequence
+    held = {}
+    # names of the signs that have been given planned
+    served = set()
+
     while not SHUTDOWN:
         try:
             # sleep and then skip to next iteration if not active
-            active = check_if_active(active, is_active, sign, textfiles)
+            active = check_if_active(active, is_active, writers)
             if not active:
+                generated = None
+                next_refresh = 0
+                held = {}
+                served = set()
                 continue
 
+            # also our sleep: wait (at most a sec) for a queued sequence
             try:
-                sequence = SEQUENCE_QUEUE.get(True, 1)
+                sequence = SEQUENCE_QUEUE.get(True, 1 / SPEED)
             except Queue.Empty:
                 sequence = None
 
-            ctx = { 'message_queue' : MESSAGE_QUEUE }
-            if not sequence:
-                try:
-                    sequence = module.sign_sequence(ctx)
-                except Exception as e:
-                    LOG.error("Error running sign_sequence(): %s" % (str(e),))
-                if not sequence:
-                    sequence = {}
+            now = time.time()
 
-            sleeptime = 60
-
-            messages = []
             if sequence:
-                messages = sequence.get('messages', [])
-                num_msgs = len(messages)
-                if num_msgs > NUM_TEXTFILES:
-                    LOG.info("WARNING: Got %d messages, which exceeds limit of %d. Truncating." % (len(messages), NUM_TEXTFILES))
-                # modify run_sequence if necessary
-                if num_msgs != len(run_sequence):
-                    LOG.debug("Re-setting run sequence")
-                    run_sequence = textfiles[0:num_msgs]
-                    sign.set_run_sequence(run_sequence)
-
-                sleeptime = int(sequence.get('duration', 60))
-
-            i = 0
-            for textfile in textfiles:
-                log = True
-                if i < len(messages):
-                    msg = messages[i]
-                else:
-                    msg = { 'mode' : 'HOLD', 'text' : '' }
-                    log = False
-                display_message(sign, msg, textfile, log=log)
-                i += 1
+                targets = list(writers)
+                routed = sequence.get('sign') is not None
+                if routed:
+                    targets = [w for w in targets if is_routed_to(sequence, w.name)]
+                    if not targets:
+                        LOG.info("WARNING: Dropping sequence for unknown sign(s): %s", sequence.get('sign'))
+                        continue
+
+                messages, duration = plan(sequence)
+                if not routed:
+                    LAST_SUBMISSION = (messages, duration, True)
+                for writer in targets:
+                    LOG.info("Showing queued sequence on sign %s for %d secs", writer.name, duration)
+                    writer.submit(messages, duration)
+                    held[writer.name] = now + duration / SPEED
+                    served.discard(writer.name)
+                continue
 
-            # let it display for given duration
-            sleep_for(sleeptime)
+            # signs whose queued sequence has run its course go back to
+            # the generated one
+            released = [w for w in writers if w.name in held and held[w.name] <= now]
+            for writer in released:
+                del held[writer.name]
+            free = [w for w in writers if w.name not in held]
+            if not free:
+                continue
+            # the released signs, and any that have joined since
+            behind = [w for w in free if w.name not in served]
+
+            if now < next_refresh and not REFRESH.is_set() and not behind:
+                continue
+
+            ctx = { 'message_queue' : MESSAGE_QUEUE, 'refresh' : REFRESH.set }
+            REFRESH.clear()
+            try:
+                sequence = module.sign_sequence(ctx)
+            except Exception as e:
+                LOG.error("Error running sign_sequence(): %s", e)
+            if not sequence:
+                sequence = {}
+
+            targets = free
+            if sequence is generated:
+                if RECORDER:
+                    RECORDER.record(TRACE_UNCHANGED)
+                if not behind:
+                    LOG.debug("Sequence hasn't changed, nothing to write")
+                    next_refresh = now + planned[1] / SPEED
+                    continue
+                # only the signs that haven't got it need it
+                targets = behind
+            else:
+                generated = sequence
+                if RECORDER:
+                    RECORDER.record_json(TRACE_SEQUENCE, sequence)
+                planned = plan(sequence) if sequence else ([], 60)
+                served = set()
+
+            # also what signs joining from now on get, now that any
+            # queued sequence it replaced has expired
+            LAST_SUBMISSION = (planned[0], planned[1], True)
+            messages, duration = planned
+            for writer in targets:
+                writer.submit(messages, duration)
+                served.add(writer.name)
+
+            # let it display for given duration, unless something changes
+            LOG.info("Refreshing in %d secs...", duration)
+            next_refresh = now + duration / SPEED
 
         except KeyboardInterrupt:
             LOG.info("Stopping...")
@@ -325,6 +2166,280 @@ def sign_loop(sign, module):
     LOG.info("Exiting sign loop")
 
 
+class FakeSign(alphasign.interfaces.base.BaseInterface):
+    """Stands in for a sign when the device is given as 'fake', for
+    trying things out without the hardware. Only counts what would
+    have been written. Given as 'fake:BAUD', writes take as long as
+    they would over a serial line at that speed.
+    """
+
+    def __init__(self, baud=None):
+        self.debug = False
+        self.packets = 0
+        self.bytes = 0
+        self.baud = baud
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def clear_memory(self):
+        pass
+
+    def write(self, packet):
+        data = str(packet)
+        self.packets += 1
+        self.bytes += len(data)
+        LOG.debug("Fake sign got packet: %r", data)
+        if self.baud:
+            # 8N1: 10 bits a byte
+            time.sleep(len(data) * 10.0 / self.baud)
+        return True
+
+
+def open_sign(device):
+    """Returns a connected alphasign interface for device"""
+    if device == 'fake':
+        return FakeSign()
+    if device.startswith('fake:'):
+        return FakeSign(int(device[len('fake:'):]))
+    sign = alphasign.Serial(device=device)
+    sign.connect()
+    sign.debug = False
+    sign.clear_memory()
+    return sign
+
+
+# a trace file is TRACE_MAGIC followed by records, each a TRACE_HEADER
+# (kind, timestamp, payload length) and the payload. Most payloads are
+# JSON; TRACE_WRITE's are a TRACE_WRITE_INFO (sign name length, secs
+# the write took), the sign name and the bytes written.
+TRACE_MAGIC = "SSTRACE1"
+TRACE_HEADER = struct.Struct('<BdI')
+TRACE_WRITE_INFO = struct.Struct('<Bd')
+
+TRACE_ENQUEUE_MESSAGE = 1
+TRACE_ENQUEUE_SEQUENCE = 2
+# what sign_sequence() returned; TRACE_UNCHANGED when it was the same as
+# last time
+TRACE_SEQUENCE = 3
+TRACE_UNCHANGED = 4
+TRACE_SOURCE = 5
+TRACE_WRITE = 6
+# live field values that changed, as {name: value}; every field is
+# first recorded with a value of None when they're registered
+TRACE_FIELDS = 7
+
+
+class TraceRecorder(object):
+    """Appends records of what goes on to a trace file (see --record),
+    for replay_trace() to play back later. Each record's flushed as
+    it's written, so a trace is good up to the moment things went wrong.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            self.f.write(TRACE_MAGIC)
+
+    def record(self, kind, payload=""):
+        header = TRACE_HEADER.pack(kind, time.time(), len(payload))
+        with self.lock:
+            self.f.write(header + payload)
+            self.f.flush()
+
+    def record_json(self, kind, obj):
+        self.record(kind, json.dumps(obj, separators=(',', ':')))
+
+    def record_write(self, name, secs, data):
+        self.record(TRACE_WRITE, TRACE_WRITE_INFO.pack(len(name), secs) + name + data)
+
+    def record_source(self, name, secs, changed, error):
+        self.record_json(TRACE_SOURCE, { 'name' : name, 'secs' : secs,
+                                         'changed' : changed, 'error' : error })
+
+
+def read_trace(path):
+    """Generator yielding (kind, timestamp, data) for each record in a
+    trace file. data is the decoded JSON, or (sign name, secs, bytes)
+    for TRACE_WRITE. Stops quietly at a record cut short by a crash.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("%s isn't a trace file" % (path,))
+        while True:
+            header = f.read(TRACE_HEADER.size)
+            if len(header) < TRACE_HEADER.size:
+                break
+            kind, timestamp, length = TRACE_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                LOG.info("WARNING: Trace %s ends with an incomplete record", path)
+                break
+            if kind == TRACE_WRITE:
+                name_length, secs = TRACE_WRITE_INFO.unpack_from(payload)
+                start = TRACE_WRITE_INFO.size
+                data = (payload[start:start + name_length], secs, payload[start + name_length:])
+            elif kind == TRACE_UNCHANGED:
+                data = None
+            else:
+                data = json.loads(payload)
+            yield (kind, timestamp, data)
+
+
+def watch_writes(sign, name, on_write):
+    """Have on_write(name, secs, data) called after everything written
+    to sign. The sign's own write is replaced, rather than the sign
+    wrapped, so writes made by its other methods are caught too.
+    """
+    write = sign.write
+
+    def watched_write(packet):
+        data = str(packet)
+        start = time.time()
+        result = write(data)
+        on_write(name, time.time() - start, data)
+        return result
+
+    sign.write = watched_write
+    return sign
+
+
+def start_recording(path):
+    global RECORDER
+    LOG.info("Recording trace to %s", path)
+    RECORDER = TraceRecorder(path)
+    sources.REFRESH_LISTENERS.append(RECORDER.record_source)
+
+
+class WriteStats(object):
+    """Totals of writes per sign"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signs = {}
+
+    def add(self, name, secs, data):
+        with self.lock:
+            stats = self.signs.setdefault(name, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += len(data)
+            stats[2] += secs
+
+
+class ReplayModule(object):
+    """Stands in for the config module when replaying a trace:
+    sign_sequence() returns the latest recorded sequence whose time
+    has come
+    """
+
+    def __init__(self):
+        self.sequence = None
+
+    def sign_sequence(self, ctx):
+        # these were already part of the recorded sequences
+        _drain(ctx['message_queue'])
+        return self.sequence
+
+    def is_active(self):
+        return True
+
+
+def replay_trace(path, device, speed):
+    """Play a trace back through sign_loop, speed times faster than it
+    was recorded, writing to fake signs (device should be 'fake' or
+    'fake:BAUD'), and report how the writes compare with the
+    recording's
+    """
+    global SPEED, SHUTDOWN
+    SPEED = speed
+
+    events = list(read_trace(path))
+    if not events:
+        LOG.error("ERROR: Trace %s has nothing in it", path)
+        return
+
+    recorded = WriteStats()
+    source_times = {}
+    field_names = set()
+    for kind, timestamp, data in events:
+        if kind == TRACE_WRITE:
+            recorded.add(*data)
+        elif kind == TRACE_SOURCE:
+            source_times.setdefault(data['name'], []).append(data['secs'])
+        elif kind == TRACE_FIELDS:
+            field_names.update(str(name) for name in data)
+    # so the same labels are used as when it was recorded
+    register_fields(field_names)
+
+    replayed = WriteStats()
+    names = sorted(recorded.signs.keys()) or ['fake']
+    writers = []
+    for name in names:
+        sign = watch_writes(open_sign(device), name, replayed.add)
+        if RECORDER:
+            watch_writes(sign, name, RECORDER.record_write)
+        writers.append(SignWriter(name, sign))
+    for writer in writers:
+        threading.Thread(target=writer.run).start()
+
+    module = ReplayModule()
+    threading.Thread(target=sign_loop, args=(writers, module)).start()
+
+    first = events[0][1]
+    LOG.info("Replaying %d records covering %ds at %gx speed...",
+             len(events), events[-1][1] - first, speed)
+    start = time.time()
+    try:
+        for kind, timestamp, data in events:
+            wait = (timestamp - first) / speed - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+            if kind == TRACE_SEQUENCE:
+                module.sequence = data
+                REFRESH.set()
+            elif kind == TRACE_ENQUEUE_SEQUENCE:
+                SEQUENCE_QUEUE.offer(data)
+            elif kind == TRACE_ENQUEUE_MESSAGE:
+                try:
+                    MESSAGE_QUEUE.put_nowait(data)
+                except Queue.Full:
+                    pass
+            elif kind == TRACE_FIELDS:
+                changed = dict((FIELDS[str(name)], value.encode('utf-8'))
+                               for name, value in data.iteritems()
+                               if value is not None and str(name) in FIELDS)
+                FIELD_VALUES.update(changed)
+                if changed:
+                    for writer in writers:
+                        writer.update_strings(changed)
+        # give the writers a chance to finish
+        time.sleep(2)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.time() - start
+    SHUTDOWN = True
+
+    print "Replayed %ds of trace in %ds" % (events[-1][1] - first, elapsed)
+    print
+    print "%-12s %24s %24s" % ("", "recorded", "replayed")
+    print "%-12s %8s %8s %6s %8s %8s %6s" % ("sign", "writes", "bytes", "secs",
+                                             "writes", "bytes", "secs")
+    for name in names:
+        r = recorded.signs.get(name, [0, 0, 0.0])
+        p = replayed.signs.get(name, [0, 0, 0.0])
+        print "%-12s %8d %8d %6.1f %8d %8d %6.1f" % tuple([name] + r + p)
+    if source_times:
+        print
+        print "%-12s %6s %8s %8s" % ("source", "calls", "avg secs", "max secs")
+        for name in sorted(source_times):
+            times = source_times[name]
+            print "%-12s %6d %8.2f %8.2f" % (name, len(times), sum(times) / len(times), max(times))
+
+
 def guess_device():
     """Returns best candidate for tty devices to use
     """
@@ -341,16 +2456,62 @@ def guess_device():
     return None
 
 
+def run_agent_main(address, devices):
+    """main() for --agent mode: no module or web server, just the sign"""
+    if ':' not in address:
+        LOG.error("ERROR: --agent needs HOST:PORT")
+        sys.exit(1)
+    host, port = address.rsplit(':', 1)
+
+    if len(devices) != 1:
+        LOG.error("ERROR: --agent drives exactly one sign")
+        sys.exit(1)
+    name, device = devices[0]
+    if name == device and not device.startswith('fake'):
+        name = socket.gethostname()
+
+    LOG.info("Initializing sign %s at %s...", name, device)
+    sign = open_sign(device)
+    if RECORDER:
+        watch_writes(sign, name, RECORDER.record_write)
+    writer = SignWriter(name, sign)
+
+    threading.Thread(target=run_agent, args=(host, int(port), writer)).start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    LOG.info("Shutting down agent...")
+
+    global SHUTDOWN
+    SHUTDOWN = True
+
+
+def parse_device(spec):
+    """Returns (name, device) tuple for a --device value of the form
+    [NAME=]DEVICE. The name defaults to the device.
+    """
+    if '=' in spec:
+        name, device = spec.split('=', 1)
+        return (name, device)
+    return (spec, spec)
+
+
 def main():
     """Main function
     """
     parser = OptionParser("%prog")
     parser.add_option("-d", "--device",
-                      help="serial/USB device to use",
-                      action="store",
+                      help="serial/USB device to use, optionally given a name "
+                      "to route messages by, as NAME=DEVICE. "
+                      "Repeat to drive more than one sign",
+                      action="append",
                       type="string",
-                      dest="device",
-                      default=None)
+                      dest="devices",
+                      default=[])
     parser.add_option("-m", "--module",
                       help="module to load for a sign_sequence() function",
                       action="store",
@@ -363,6 +2524,115 @@ def main():
                       type="string",
                       dest="port",
                       default="8000")
+    parser.add_option("--agent-port",
+                      help="port to listen on for sign agents",
+                      action="store",
+                      type="int",
+                      dest="agent_port",
+                      default=None)
+    parser.add_option("-s", "--socket",
+                      help="also accept messages from local programs on a "
+                      "Unix domain socket at this path (see simplesign_client.py)",
+                      action="store",
+                      type="string",
+                      dest="socket",
+                      default=None)
+    parser.add_option("--agent",
+                      help="run as an agent for a sign attached to this "
+                      "machine, getting what to display from the "
+                      "simplesign.py at HOST:PORT",
+                      action="store",
+                      type="string",
+                      dest="agent",
+                      default=None)
+    parser.add_option("--max-messages",
+                      help="max number of messages waiting to be added to "
+                      "the sequence (default %default)",
+                      action="store",
+                      type="int",
+                      dest="max_messages",
+                      default=MAX_QUEUED_MESSAGES)
+    parser.add_option("--max-sequences",
+                      help="max number of queued pre-empting sequences "
+                      "(default %default)",
+                      action="store",
+                      type="int",
+                      dest="max_sequences",
+                      default=MAX_QUEUED_SEQUENCES)
+    parser.add_option("--rate",
+                      help="requests per second each client can make to "
+                      "the enqueue endpoints, 0 for no limit (default %default)",
+                      action="store",
+                      type="float",
+                      dest="rate",
+                      default=RATE)
+    parser.add_option("--burst",
+                      help="requests each client can make at once before "
+                      "--rate kicks in (default %default)",
+                      action="store",
+                      type="int",
+                      dest="burst",
+                      default=BURST)
+    parser.add_option("--isolate",
+                      help="run the module's sign_sequence() in a separate "
+                      "worker process",
+                      action="store_true",
+                      dest="isolate",
+                      default=False)
+    parser.add_option("--worker-timeout",
+                      help="with --isolate, secs to wait for sign_sequence() "
+                      "before killing the worker (default %default)",
+                      action="store",
+                      type="int",
+                      dest="worker_timeout",
+                      default=WORKER_TIMEOUT)
+    parser.add_option("--worker-max-calls",
+                      help="with --isolate, replace the worker after this "
+                      "many sign_sequence() calls, 0 for never (default %default)",
+                      action="store",
+                      type="int",
+                      dest="worker_max_calls",
+                      default=WORKER_MAX_CALLS)
+    parser.add_option("--log-file",
+                      help="log to this file instead of stderr",
+                      action="store",
+                      type="string",
+                      dest="log_file",
+                      default=None)
+    parser.add_option("--log-max-bytes",
+                      help="start a new log file when it reaches this size "
+                      "(default %default)",
+                      action="store",
+                      type="int",
+                      dest="log_max_bytes",
+                      default=LOG_MAX_BYTES)
+    parser.add_option("--log-backups",
+                      help="number of old log files to keep (default %default)",
+                      action="store",
+                      type="int",
+                      dest="log_backups",
+                      default=LOG_BACKUPS)
+    parser.add_option("--record",
+                      help="append a trace of messages, sequences, source "
+                      "refreshes and sign writes to this file",
+                      action="store",
+                      type="string",
+                      dest="record",
+                      default=None)
+    parser.add_option("--replay",
+                      help="play back a trace made with --record, on fake "
+                      "signs, and compare the writes",
+                      action="store",
+                      type="string",
+                      dest="replay",
+                      default=None)
+    parser.add_option("--speed",
+                      help="with --replay, how many times faster than real "
+                      "time to play it back (default %default)",
+                      action="store",
+                      type="float",
+                      dest="speed",
+                      default=10.0)
     parser.add_option("-v", "--verbose",
                       help="turn on verbose messages for debugging",
                       action="store_true",
@@ -374,37 +2644,89 @@ def main():
     level = logging.INFO
     if options.verbose:
         level = logging.DEBUG
-    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=level)
+    setup_logging(level, options.log_file, options.log_max_bytes, options.log_backups)
+
+    if options.record:
+        start_recording(options.record)
+    replay = options.replay and os.path.abspath(options.replay)
 
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
-    device = options.device
-    if not device:
+    devices = [parse_device(spec) for spec in options.devices]
+
+    if replay:
+        device = devices[0][1] if devices else 'fake'
+        if not device.startswith('fake'):
+            LOG.error("ERROR: --replay only writes to fake signs")
+            sys.exit(1)
+        replay_trace(replay, device, options.speed)
+        return
+
+    if not devices and not options.agent_port:
         device = guess_device()
+        devices = [(device, device)]
+
+    if options.agent:
+        run_agent_main(options.agent, devices)
+        return
 
     module = None
     try:
         results = imp.find_module(options.module)
         args = (options.module,) + results
         module = imp.load_module(*args)
-        LOG.info("Module '%s' loaded successfully" % (options.module,))
+        LOG.info("Module '%s' loaded successfully", options.module)
     except ImportError as e:
-        LOG.error("ERROR: Could not find module '%s': %s" % (options.module, str(e)))
+        LOG.error("ERROR: Could not find module '%s': %s", options.module, e)
         sys.exit(1)
     if getattr(module, 'sign_sequence', None) is None:
-        LOG.error("ERROR: Module '%s' has no function sign_sequence()" % (options.module,))
+        LOG.error("ERROR: Module '%s' has no function sign_sequence()", options.module)
+        sys.exit(1)
+    if options.socket and not remove_stale_socket(options.socket):
+        LOG.error("ERROR: %s already exists and isn't a socket", options.socket)
         sys.exit(1)
 
-    LOG.info("Initializing sign at %s..." % (device,))
-    sign = alphasign.Serial(device=device)
-    sign.connect()
-    sign.debug = False
-    sign.clear_memory()
+    global SEQUENCE_QUEUE, MESSAGE_QUEUE, RATE_LIMITER
+    SEQUENCE_QUEUE = SequenceQueue(options.max_sequences)
+    MESSAGE_QUEUE = Queue.Queue(options.max_messages)
+    RATE_LIMITER = RateLimiter(options.rate, options.burst)
+
+    fields = getattr(module, 'LIVE_FIELDS', {})
+    register_fields(fields.keys())
+    if RECORDER:
+        RECORDER.record_json(TRACE_FIELDS, dict((name, None) for name in fields))
+
+    writers = []
+    for name, device in devices:
+        LOG.info("Initializing sign %s at %s...", name, device)
+        sign = open_sign(device)
+        if RECORDER:
+            watch_writes(sign, name, RECORDER.record_write)
+        writers.append(SignWriter(name, sign))
+
+    threading.Thread(target=BROADCASTER.run).start()
 
     threading.Thread(target=start_server, args=(int(options.port),)).start()
 
+    if options.socket:
+        threading.Thread(target=start_local_server, args=(options.socket,)).start()
+
+    LOG.info("Starting sign writer threads...")
+    for writer in writers:
+        threading.Thread(target=writer.run).start()
+
+    if options.agent_port:
+        threading.Thread(target=start_agent_server, args=(options.agent_port, writers)).start()
+
+    sequence_module = module
+    if options.isolate:
+        sequence_module = WorkerModule(module, options.worker_timeout, options.worker_max_calls)
+
     LOG.info("Starting sign loop thread...")
-    threading.Thread(target=sign_loop, args=(sign, module)).start()
+    threading.Thread(target=sign_loop, args=(writers, sequence_module)).start()
+
+    if fields:
+        threading.Thread(target=field_loop, args=(writers, fields)).start()
 
     try:
         time.sleep(2)
@@ -418,6 +2740,7 @@ def main():
 
     global SHUTDOWN
     SHUTDOWN = True
+    sources.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+
+Client for simplesign.py's local socket (see its --socket option), for
+cron jobs, build hooks and other programs running on the same machine
+as the sign. It skips HTTP altogether, and a Client keeps its
+connection open, so sending lots of messages is cheap.
+
+    import simplesign_client
+
+    client = simplesign_client.Client("/path/to/simplesign.sock")
+    client.message("Build #123 passed", color='GREEN')
+    client.sequence([{ 'text' : "BUILD BROKEN", 'color' : 'RED' }],
+                    duration=60)
+
+Or from the shell:
+
+    ./simplesign_client.py -s /path/to/simplesign.sock "Backup finished"
+
+Only uses the standard library, so it can be copied next to whatever
+needs it.
+
+"""
+
+from optparse import OptionParser
+import json
+import socket
+import sys
+
+
+DEFAULT_SOCKET = "simplesign.sock"
+
+
+class EnqueueError(Exception):
+    """Raised when simplesign.py won't take a message or sequence.
+    code is the equivalent HTTP status (eg. 503 when its queue is full),
+    and retry_after, if set, how many secs to wait before trying again.
+    """
+
+    def __init__(self, code, message, retry_after=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+class Client(object):
+    """Connects on first use, and reconnects once if sending fails
+    because simplesign.py has been restarted since. Requests are never
+    resent once they've gone out, in case they were queued.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.buf = b""
+
+    def connect(self):
+        self.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.buf = b""
+
+    def _readline(self):
+        while b"\n" not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("Connection closed")
+            self.buf += data
+        line, self.buf = self.buf.split(b"\n", 1)
+        return line
+
+    def _request(self, request):
+        data = (json.dumps(request) + "\n").encode('utf-8')
+        for attempt in (1, 2):
+            try:
+                if not self.sock:
+                    self.connect()
+                self.sock.sendall(data)
+                break
+            except socket.error:
+                self.close()
+                if attempt == 2:
+                    raise
+        # once it's been sent it may have been queued, so don't send it
+        # again if the reply doesn't come back
+        try:
+            response = json.loads(self._readline().decode('utf-8'))
+        except (socket.error, ValueError):
+            self.close()
+            raise
+        if not response.get('ok'):
+            raise EnqueueError(response.get('code'), response.get('error'),
+                               response.get('retry_after'))
+
+    def message(self, text, **kwargs):
+        """Queue a message to be included in the default sequence.
+        kwargs are the other message keys: mode, color, speed, sign...
+        """
+        msg = dict(kwargs)
+        msg['text'] = text
+        self._request({ 'message' : msg })
+
+    def sequence(self, messages, duration='auto', **kwargs):
+        """Queue a sequence of messages (dicts) to be shown asap, for
+        duration secs. kwargs are any other sequence keys.
+        """
+        seq = dict(kwargs)
+        seq['messages'] = messages
+        seq['duration'] = duration
+        self._request({ 'sequence' : seq })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = OptionParser("%prog [options] TEXT")
+    parser.add_option("-s", "--socket",
+                      help="simplesign.py's local socket (default %default)",
+                      action="store",
+                      type="string",
+                      dest="socket",
+                      default=DEFAULT_SOCKET)
+    parser.add_option("-c", "--color",
+                      action="store",
+                      type="string",
+                      dest="color",
+                      default=None)
+    parser.add_option("-m", "--mode",
+                      action="store",
+                      type="string",
+                      dest="mode",
+                      default=None)
+    parser.add_option("-n", "--now",
+                      help="show it right away, for this many secs, instead "
+                      "of adding it to the default sequence",
+                      action="store",
+                      type="int",
+                      dest="now",
+                      default=None)
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need the TEXT to display")
+
+    msg = { 'text' : args[0] }
+    if options.color:
+        msg['color'] = options.color
+    if options.mode:
+        msg['mode'] = options.mode
+
+    with Client(options.socket) as client:
+        try:
+            if options.now:
+                client.sequence([msg], duration=options.now)
+            else:
+                client.message(**msg)
+        except EnqueueError as e:
+            sys.stderr.write("Couldn't queue message: %s\n" % (e,))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
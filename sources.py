@@ -0,0 +1,512 @@
+"""
+
+Helpers for config modules that build their sequence out of several
+sources of messages (feeds, scraped pages, local files...), each of
+which only needs refreshing every so often.
+
+Rather than re-fetching everything whenever sign_sequence() is called,
+each source is registered with a SourceStore along with how often it
+should be refreshed. The store refreshes each one on its own schedule
+in the background and keeps the latest results. A function decorated
+with SourceStore.composer is only re-run when one of those results
+actually changed; otherwise it returns the very same sequence object
+as last time, which simplesign.py takes to mean there's nothing new to
+write to the sign.
+
+    STORE = sources.SourceStore()
+    STORE.add('weather', weather, 15 * 60)
+    STORE.add('news', news, 5 * 60)
+
+    @STORE.composer
+    def compose(values):
+        return { 'duration' : 300,
+                 'messages' : values['weather'] + values['news'] }
+
+    def sign_sequence(ctx):
+        STORE.start(ctx)
+        return compose()
+
+Local files can be watched for changes too, so a source that reads
+one is refreshed as soon as the file is updated, and the file's only
+re-parsed when it actually changed:
+
+    QUOTES = sources.WatchedFile('quotes.txt', lambda s: s.splitlines())
+    STORE.add('quotes', lambda: QUOTES.snapshot.sample(4), 5 * 60,
+              watch=[QUOTES])
+
+"""
+
+import array
+import atexit
+import ctypes
+import ctypes.util
+import importlib
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+# functions called with (source name, secs taken, whether it changed,
+# error message or None) after each refresh; simplesign.py's --record
+# uses this
+REFRESH_LISTENERS = []
+
+# set by stop(); the background threads exit when they see it
+_STOPPING = threading.Event()
+_THREADS = []
+
+
+class Source(object):
+    """A named input: fn is called every 'interval' secs and its
+    result kept by the SourceStore.
+    """
+
+    def __init__(self, name, fn, interval, default):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.default = default
+        self.last_refreshed = 0
+        # whether it's been refreshed successfully yet
+        self.ready = False
+
+
+class SourceStore(object):
+    """Holds the latest value of each source, plus a version number
+    that goes up whenever any value changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._values = {}
+        self._watched = []
+        self._started = False
+        self.version = 0
+        # called with no args whenever a value changes; see start()
+        self.on_change = None
+
+    def add(self, name, fn, interval, default=None, watch=()):
+        """Register a source. default (an empty list if not given) is
+        its value until the first refresh. watch is a list of
+        WatchedFiles that fn reads; the source is also refreshed
+        whenever one of them changes.
+        """
+        if default is None:
+            default = []
+        self._sources[name] = Source(name, fn, interval, default)
+        self._values[name] = default
+        for watched in watch:
+            self._watched.append(watched)
+            watched.on_change.append(lambda: self._started and self.refresh(name))
+
+    def source(self, interval, name=None, default=None, watch=()):
+        """Decorator version of add()"""
+        def decorator(fn):
+            self.add(name or fn.__name__, fn, interval, default, watch)
+            return fn
+        return decorator
+
+    def get(self, name):
+        return self._values[name]
+
+    def loading(self):
+        """Returns the names of sources that haven't been refreshed
+        successfully yet
+        """
+        return sorted(name for name, source in self._sources.items() if not source.ready)
+
+    def values(self):
+        """Returns a dict (a snapshot; don't modify it) of all values"""
+        return self._values
+
+    def set(self, name, value, notify=True):
+        """Set a value directly, for inputs that are pushed rather than
+        refreshed on a schedule. Returns True if it changed. Pass
+        notify=False from within sign_sequence(), which is about to
+        compose anyway.
+        """
+        with self._lock:
+            if name in self._values and self._values[name] == value:
+                return False
+            # copy-on-write, so values() snapshots stay consistent
+            values = dict(self._values)
+            values[name] = value
+            self._values = values
+            self.version += 1
+        LOG.debug("Source %s changed", name)
+        if notify and self.on_change:
+            self.on_change()
+        return True
+
+    def refresh(self, name):
+        """Call a source's function now and store the result. Errors
+        are logged and leave the old value in place.
+        """
+        source = self._sources[name]
+        source.last_refreshed = start = time.time()
+        try:
+            value = source.fn()
+        except Exception as e:
+            LOG.error("Error refreshing source %s: %s", name, e)
+            self._refreshed(name, start, False, str(e))
+            return False
+        first = not source.ready
+        source.ready = True
+        changed = self.set(name, value)
+        if first and not changed:
+            # loading() has changed even though the value hasn't, so
+            # the composer needs to run again
+            with self._lock:
+                self.version += 1
+            if self.on_change:
+                self.on_change()
+        self._refreshed(name, start, changed, None)
+        return changed
+
+    def _refreshed(self, name, start, changed, error):
+        for listener in REFRESH_LISTENERS:
+            listener(name, time.time() - start, changed, error)
+
+    def _refresh_loop(self, source):
+        while not _STOPPING.is_set():
+            wait = source.last_refreshed + source.interval - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 1))
+                continue
+            self.refresh(source.name)
+
+    def start(self, ctx=None, wait=False):
+        """Start a background thread per source to keep it fresh. Only
+        does anything the first time it's called, so it's fine to call
+        from sign_sequence(). If ctx has a 'refresh' function, it's
+        called on every change so the sign picks up new values right
+        away.
+
+        The first refresh of each source happens in its thread, so
+        start() returns straight away and sources come in as they're
+        ready; until then they have their defaults (see loading()).
+        With wait=True, every source is refreshed once before start()
+        returns instead.
+        """
+        if self._started:
+            return
+
+        for watched in self._watched:
+            watched.start(wait)
+
+        self._started = True
+
+        if wait:
+            for name in sorted(self._sources.keys()):
+                self.refresh(name)
+
+        if ctx and ctx.get('refresh'):
+            self.on_change = ctx['refresh']
+
+        for source in self._sources.values():
+            _start_thread(self._refresh_loop, source)
+
+    def composer(self, fn):
+        """Decorator for a function taking a dict of source values and
+        returning a sequence. The wrapper takes no args, and only calls
+        fn when something's changed since the last call; otherwise it
+        returns the previous result.
+        """
+        memo = {}
+
+        def wrapper():
+            version = self.version
+            if memo.get('version') != version:
+                memo['result'] = fn(self.values())
+                memo['version'] = version
+            return memo['result']
+
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+
+
+class IndexedList(object):
+    """Read-only list of strings, packed into a single string plus an
+    array of offsets rather than an object per item. Items are
+    returned as unicode. Supports len(), indexing and iteration, and
+    sample(n) to pick n items at random in O(n).
+    """
+
+    def __init__(self, items):
+        offsets = array.array('L', [0])
+        parts = []
+        end = 0
+        for item in items:
+            if not isinstance(item, unicode):
+                item = item.decode('utf-8')
+            parts.append(item)
+            end += len(item)
+            offsets.append(end)
+        self._data = u"".join(parts)
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("IndexedList index out of range")
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def sample(self, n):
+        """n different items picked at random (fewer if there aren't
+        that many)
+        """
+        return [self[i] for i in random.sample(xrange(len(self)), min(n, len(self)))]
+
+
+class WatchedFile(object):
+    """A local file whose contents are parsed, with parse(contents),
+    into an IndexedList. Once start()ed, it's re-parsed in the
+    background whenever the file changes, and the functions in
+    on_change are called. snapshot is replaced in one go, so readers
+    see either the old contents or the new, never a mix; hang on to
+    the snapshot rather than reading the attribute twice.
+    """
+
+    def __init__(self, path, parse):
+        self.path = path
+        self.parse = parse
+        self.snapshot = IndexedList([])
+        self.on_change = []
+        # checked on a timer, because inotify isn't available for it
+        self.polled = False
+        self._stat = None
+        self._started = False
+
+    def start(self, wait=True):
+        """Start watching the file, loading it now, or with wait=False,
+        in the background
+        """
+        if self._started:
+            return
+        self._started = True
+        if wait:
+            self.check()
+        _file_watcher().add(self, check=not wait)
+
+    def check(self):
+        """Re-parse the file if it changed since last time. If it's
+        gone, the old snapshot is kept.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            if self._stat is not None:
+                LOG.info("%s has gone, keeping what was loaded from it", self.path)
+            self._stat = None
+            return False
+
+        stat = (st.st_mtime, st.st_size, st.st_ino)
+        if stat == self._stat:
+            return False
+        self._stat = stat
+
+        try:
+            with open(self.path) as f:
+                snapshot = IndexedList(self.parse(f.read()))
+        except Exception as e:
+            LOG.error("Error loading %s: %s", self.path, e)
+            return False
+        self.snapshot = snapshot
+        LOG.info("Loaded %d items from %s", len(snapshot), self.path)
+
+        for fn in self.on_change:
+            fn()
+        return True
+
+
+# how often (secs) to check files that can't be watched with inotify
+POLL_INTERVAL = 5
+
+# inotify is Linux only; elsewhere files are polled
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+# the directory's watched rather than the file, to see files that are
+# replaced by renaming a new one over them
+IN_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class FileWatcher(object):
+    """Background thread that checks WatchedFiles when inotify says
+    their directory changed, or every POLL_INTERVAL secs for those it
+    can't watch
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = []
+        # files to check as soon as possible
+        self._new = []
+        self._dirs = {}
+        self._fd = None
+        if _libc:
+            fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+        if self._fd is None:
+            LOG.info("inotify isn't available, polling files for changes")
+        _start_thread(self._run)
+
+    def add(self, watched, check=False):
+        """Start watching a WatchedFile. With check=True, it's also
+        checked (so loaded) in the background right away.
+        """
+        if self._fd is not None:
+            directory = os.path.dirname(os.path.abspath(watched.path))
+            wd = _libc.inotify_add_watch(self._fd, directory, IN_EVENTS)
+            if wd >= 0:
+                self._dirs[wd] = directory
+            else:
+                LOG.info("Can't watch %s (%s), polling it instead",
+                         directory, os.strerror(ctypes.get_errno()))
+                watched.polled = True
+        else:
+            watched.polled = True
+        with self._lock:
+            self._files.append(watched)
+            if check:
+                self._new.append(watched)
+
+    def _read_events(self):
+        """Returns the set of paths inotify has news of, or None if
+        events were lost and everything needs checking
+        """
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError:
+            return set()
+        paths = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self._dirs:
+                paths.add(os.path.join(self._dirs[wd], name))
+        return paths
+
+    def _check(self, watched):
+        try:
+            watched.check()
+        except Exception as e:
+            LOG.error("Error checking %s: %s", watched.path, e)
+
+    def _run(self):
+        last_poll = time.time()
+        while not _STOPPING.is_set():
+            with self._lock:
+                new, self._new = self._new, []
+            for watched in new:
+                self._check(watched)
+
+            if self._fd is not None:
+                ready = select.select([self._fd], [], [], 1)[0]
+                if ready:
+                    paths = self._read_events()
+                    with self._lock:
+                        files = list(self._files)
+                    for watched in files:
+                        if paths is None or os.path.abspath(watched.path) in paths:
+                            self._check(watched)
+            else:
+                time.sleep(1)
+
+            if time.time() - last_poll >= POLL_INTERVAL:
+                last_poll = time.time()
+                with self._lock:
+                    files = [w for w in self._files if w.polled]
+                for watched in files:
+                    self._check(watched)
+
+
+_FILE_WATCHER = None
+_FILE_WATCHER_LOCK = threading.Lock()
+
+
+def _start_thread(target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    _THREADS.append(t)
+
+
+def stop(timeout=10):
+    """Stop the background threads, giving any refresh that's under
+    way up to timeout secs to finish. Also done at exit: a thread still
+    running when the interpreter shuts down crashes it if it imports
+    anything (eg. a LazyModule's first use).
+    """
+    _STOPPING.set()
+    deadline = time.time() + timeout
+    for t in list(_THREADS):
+        t.join(max(deadline - time.time(), 0))
+
+
+atexit.register(stop)
+
+
+class LazyModule(object):
+    """Stands in for a module that's slow to import (eg. bs4), which
+    is only imported when it's first used. That way importing a config
+    module is quick, and the import happens in the background along
+    with the first refresh of a source that needs it.
+
+        requests = sources.LazyModule('requests')
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            LOG.debug("Importing %s", self._name)
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def _file_watcher():
+    """The FileWatcher, started the first time it's needed (so not in a
+    process that's only imported the config module)
+    """
+    global _FILE_WATCHER
+    with _FILE_WATCHER_LOCK:
+        if _FILE_WATCHER is None:
+            _FILE_WATCHER = FileWatcher()
+        return _FILE_WATCHER
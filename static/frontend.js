@@ -0,0 +1,82 @@
+$(document).ready(function() {
+    // This should be changed if this file is served
+    // statically from a machine different from where
+    // simplesign.py is being run
+    var HOST = window.location.hostname;
+    var PORT = 8000;
+
+    var renderCurrent = function(current) {
+        var div = $("#current").empty();
+        var names = $.map(current.signs, function(sign, name) { return name; }).sort();
+        $.each(names, function(i, name) {
+            var sign = current.signs[name];
+            if(names.length > 1) {
+                div.append($("<h3>").text(name));
+            }
+            var list = $("<ul>").appendTo(div);
+            if(!sign.active) {
+                list.append($("<li>").text("(sign is sleeping)"));
+                return;
+            }
+            $.each(sign.messages, function(j, message) {
+                if($.trim(message.text) !== '') {
+                    list.append($("<li>").text(message.text));
+                }
+            });
+        });
+    };
+
+    if(window.EventSource) {
+        var events = new EventSource("http://" + HOST + ":" + PORT + "/events");
+        events.addEventListener("sequence", function(e) {
+            renderCurrent(JSON.parse(e.data));
+        });
+    }
+
+    $("#submit").click(function() {
+        var message = {
+            'text' : $("#text").val(),
+            'color' : $("#color").find(":selected").text(),
+            'mode' : $("#mode").find(":selected").text()
+        };
+        var objToSend = message;
+        var endpoint = "enqueue_message";
+        if($("input[name='type']:checked").val() === 'asap') {
+            var duration = $("#duration").find(":selected").text();
+            duration = parseInt(duration, 10) * 60;
+            var sequence = {
+                'duration' : duration,
+                'messages' : [ message ]
+            };
+            objToSend = sequence;
+            endpoint = "enqueue_sequence";
+        }
+        console.log(objToSend);
+        $("#submit").prop("disabled", true);
+        $("#submit").attr("value", "Please wait...");
+        $.ajax("http://" + HOST + ":" + PORT + "/" + endpoint, {
+            'type' : 'POST',
+            'data' : JSON.stringify(objToSend),
+            'success' : function (data, textStatus, jqXHR) {
+                $("#status").text("Your message has been queued.");
+                $("#message").val('');
+            },
+            'error' : function (jqXHR, textStatus, errorThrown) {
+                var retryAfter = jqXHR.getResponseHeader("Retry-After");
+                if(retryAfter) {
+                    $("#status").text("The sign is busy (" + jqXHR.statusText + "), please try again in " + retryAfter + " second(s).");
+                } else {
+                    $("#status").text("There was an error queuing your message: " + textStatus);
+                }
+            },
+            'complete' : function() {
+                $("#submit").prop("disabled", false);
+                $("#submit").attr("value", "Queue It!");
+                setTimeout(function() {
+                    $("#status").text('');
+                }, 5000);
+            }
+        });
+        return false;
+    });
+});